@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpaper manager for Sway, i3 and some other WMs, as a frontend to swaybg and feh
+
+Zip and tar archives browsed as folders: members are read straight out of the archive, w/o extracting. Archives get
+listed once (the zip central directory, or tar headers), and the offset of each member stored, so that reading a member
+later takes a single seek. Compressed tar files have no random access: a member read is decompressed from the
+beginning of the archive, so that many members get extracted at once, in a single pass (see extract_members).
+
+Members are addressed by virtual paths: archive path/member name.
+
+Author: Piotr Miller
+e-mail: nwg.piotr@gmail.com
+Website: http://nwg.pl
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+
+EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Exceptions of archives we failed to read
+ERRORS = (OSError, EOFError, zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, zlib.error)
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+
+def is_archive(name):
+    return name.lower().endswith(EXTENSIONS)
+
+
+def split_path(path, is_archive_file):
+    """
+    :param path: file path, possibly virtual
+    :param is_archive_file: function telling if the path given is of an archive file
+    :return: (archive path, member name) tuple, or None if not a member of an archive
+    """
+    parts = path.split('/')
+    for i in range(1, len(parts) - 1):
+        if is_archive(parts[i]):
+            archive_path = '/'.join(parts[:i + 1])
+            if is_archive_file(archive_path):
+                return archive_path, '/'.join(parts[i + 1:])
+    return None
+
+
+def member_name(name):
+    """
+    :return: normalized member name, as in virtual paths; None if pointing outside the archive
+    """
+    name = os.path.normpath(name)
+    return None if name.startswith(('/', '..')) else name
+
+
+def list_members(path, header_bytes):
+    """
+    :param path: archive path
+    :param header_bytes: number of bytes of each member to return, for its format to be told
+    :return: (kind, [(member record, first bytes of the member)]) tuple. Kind: 'zip', 'tar', or 'tar-stream' if
+    compressed. Member record: [name, offset, compressed size, size, compression method]; the offset of the zip local
+    header, or of tar member data; None if not seekable.
+    """
+    members = []
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                # encrypted members skipped, and these not named as in virtual paths
+                if info.is_dir() or info.flag_bits & 0x1 or member_name(info.filename) != info.filename:
+                    continue
+                with zf.open(info) as f:
+                    header = f.read(header_bytes)
+                members.append(([info.filename, info.header_offset, info.compress_size, info.file_size,
+                                 info.compress_type], header))
+        return 'zip', members
+
+    try:
+        tf = tarfile.open(path, 'r:')
+        kind = 'tar'
+    except tarfile.ReadError:
+        tf = tarfile.open(path, 'r:*')
+        kind = 'tar-stream'
+    with tf:
+        for info in tf:
+            name = member_name(info.name)
+            if not info.isfile() or not name:
+                continue
+            header = tf.extractfile(info).read(header_bytes)
+            members.append(([name, info.offset_data if kind == 'tar' else None, info.size, info.size, None], header))
+    return kind, members
+
+
+def read_member(path, kind, record):
+    """
+    :param path: archive path
+    :param kind: as returned by list_members
+    :param record: member record, as returned by list_members; fields appended ignored
+    :return: member content bytes
+    """
+    name, offset, compressed_size, size, compression = record[:5]
+    if kind == 'zip':
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+            if signature != b'PK\x03\x04':
+                raise zipfile.BadZipFile('Bad local header of {}'.format(name))
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            data = f.read(compressed_size)
+        if compression == zipfile.ZIP_DEFLATED:
+            # never more than the central directory says, whatever the stream
+            data = zlib.decompressobj(-15).decompress(data, size + 1)
+        elif compression != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(path) as zf:
+                data = zf.read(name)
+    elif kind == 'tar':
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+    else:
+        data = b''
+        with tarfile.open(path, 'r:*') as tf:
+            # names normalized in virtual paths; the first member matching will do
+            for info in tf:
+                if info.isfile() and member_name(info.name) == name:
+                    data = tf.extractfile(info).read()
+                    break
+    if len(data) != size:
+        raise EOFError('{}: {} bytes read, {} expected'.format(name, len(data), size))
+    return data
+
+
+def extract_member(path, kind, record, dest_path):
+    """
+    Writes the member to a real file, for programs which need one
+    """
+    data = read_member(path, kind, record)
+    tmp_path = '{}.azote-{}'.format(dest_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, dest_path)
+
+
+def extract_members(path, names, dest_dir):
+    """
+    Writes members of a compressed tar to real files in a single pass, instead of decompressing the archive from the
+    beginning for each member
+    :param path: archive path
+    :param names: member names, as in virtual paths
+    :param dest_dir: folder to write files to
+    :return: {member name: path of the file extracted}
+    """
+    names = set(names)
+    extracted = {}
+    with tarfile.open(path, 'r:*') as tf:
+        for i, info in enumerate(tf):
+            name = member_name(info.name)
+            if not info.isfile() or name not in names or name in extracted:
+                continue
+            dest_path = os.path.join(dest_dir, '{}-{}'.format(i, os.path.basename(name)))
+            with open(dest_path, 'wb') as f:
+                f.write(tf.extractfile(info).read())
+            extracted[name] = dest_path
+            if len(extracted) == len(names):
+                break
+    return extracted
@@ -128,6 +128,14 @@ class MMCQ(object):
             bmax = max(bval, bmax)
         return VBox(rmin, rmax, gmin, gmax, bmin, bmax, histo)
 
+    @staticmethod
+    def vbox_from_histo(histo):
+        indexes = list(histo)
+        rvals = [index >> (2 * MMCQ.SIGBITS) for index in indexes]
+        gvals = [(index >> MMCQ.SIGBITS) & ((1 << MMCQ.SIGBITS) - 1) for index in indexes]
+        bvals = [index & ((1 << MMCQ.SIGBITS) - 1) for index in indexes]
+        return VBox(min(rvals), max(rvals), min(gvals), max(gvals), min(bvals), max(bvals), histo)
+
     @staticmethod
     def median_cut_apply(histo, vbox):
         if not vbox.count:
@@ -228,6 +236,26 @@ class MMCQ(object):
 
         # get the beginning vbox from the colors
         vbox = MMCQ.vbox_from_pixels(pixels, histo)
+        return MMCQ.median_cut(histo, vbox, max_color)
+
+    @staticmethod
+    def quantize_histo(histo, max_color):
+        """Quantize a histogram, as returned by get_histo, with no pixels
+        at hand.
+
+        :param histo: {color index: number of pixels} dictionary
+        :param max_color: max number of colors
+        """
+        if not histo:
+            raise Exception('Empty histogram when quantize.')
+        if max_color < 2 or max_color > 256:
+            raise Exception('Wrong number of max colors when quantize.')
+
+        vbox = MMCQ.vbox_from_histo(histo)
+        return MMCQ.median_cut(histo, vbox, max_color)
+
+    @staticmethod
+    def median_cut(histo, vbox, max_color):
         pq = PQueue(lambda x: x.count)
         pq.push(vbox)
 
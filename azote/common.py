@@ -37,11 +37,14 @@ apply_to_all_button = None
 
 cols = 3                # number of columns in pictures preview
 
-allowed_file_types = ['jpg', 'jpeg', 'png']
-associations = None     # dictionary {'extension": [program1, program2, program3, ...]}
+picture_formats = {}    # {path: (st_mtime_ns, st_size, format name or None)}, see tools.picture_format()
+archives = {}           # {archive path: (st_mtime_ns, kind, {member name: record})}, see tools.archive_pictures()
+extracted = {}          # {virtual path: file path} of members of compressed tars, see tools.extract_streams()
+associations = None     # dictionary {'format name": [program1, program2, program3, ...]}
 
 app_dir = ''            # ~/.azote
 thumb_dir = ''          # ~/.azote/thumbnails
+shared_thumb_dir = ''   # $XDG_CACHE_HOME/thumbnails or ~/.cache/thumbnails (freedesktop spec)
 tmp_dir = ''            # ~/.azote/temp
 bcg_dir = ''            # ~/.azote/backgrounds-sway or ~/.azote/backgrounds-feh
 sample_dir = ''         # ~/.azote/sample
@@ -56,6 +59,7 @@ xresources = ''
 data_migrated = False
 
 logging_enabled = True
+headless = False        # running w/o GTK, to pre-warm the thumbnail cache
 displays = None         # detected displays details
 
 settings = None         # object saved to / restored from ~/.azote/settings.pkl
@@ -73,4 +77,11 @@ dotfile_window = None
 picker_window = None
 indicator = None
 
+image_backend = None      # PillowBackend or VipsBackend object, see image_backend.py
+thumb_index = None        # ThumbnailIndex object, data_home/thumbnails.db
+thumb_pack = None         # ThumbnailPack object of the current folder, if packed thumbnails enabled
+checkerboard = None       # cairo pattern to letterbox thumbnails with
+thumbnail_scan = None     # (generator, folder, GLib source id) of thumbnails being created in the background
+thumbnail_queue = None    # JobQueue of thumbnails waiting to be created in the background
+
 color_names = None
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpaper manager for Sway, i3 and some other WMs, as a frontend to swaybg and feh
+
+Image backends: what decodes, resizes and crops pictures. Pillow is always there; libvips (the pyvips module) is
+used if installed, as it shrinks pictures on load in all formats, and streams them through a demand-driven pipeline
+instead of decoding whole images into memory. Thumbnails are handed over to the rest of Azote as PIL images either way.
+
+Picture formats are told by the file header, not by the extension. Decoders of formats Pillow doesn't handle on its
+own (HEIC, and AVIF before Pillow 11.2) come from optional plugins, imported the first time such a file is found.
+
+Author: Piotr Miller
+e-mail: nwg.piotr@gmail.com
+Website: http://nwg.pl
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import importlib
+
+from PIL import Image, features
+
+# pyvips module may or may not be available; it raises OSError if the libvips library is missing
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+
+# {format name: MIME type}
+FORMATS = {'jpeg': 'image/jpeg',
+           'png': 'image/png',
+           'webp': 'image/webp',
+           'avif': 'image/avif',
+           'tiff': 'image/tiff',
+           'bmp': 'image/bmp',
+           'heic': 'image/heic'}
+
+# Number of bytes of the file header probe() needs
+HEADER_BYTES = 64
+
+# ISO base media file format brands
+AVIF_BRANDS = {b'avif', b'avis'}
+HEIC_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs'}
+HEIF_BRANDS = {b'mif1', b'msf1'}
+
+
+def probe(header):
+    """
+    :param header: first HEADER_BYTES bytes of the file
+    :return: format name (a FORMATS key), or None if not a picture of a known format
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[:4] in [b'II*\x00', b'MM\x00*']:
+        return 'tiff'
+    if header[:2] == b'BM' and len(header) >= 14:
+        return 'bmp'
+    if header[4:8] == b'ftyp':
+        # major brand, then compatible brands, up to the end of the 'ftyp' box
+        major = header[8:12]
+        brands = {header[i:i + 4] for i in range(16, min(int.from_bytes(header[:4], 'big'), len(header)) - 3, 4)}
+        if major in AVIF_BRANDS:
+            return 'avif'
+        if major in HEIC_BRANDS:
+            return 'heic'
+        if brands & AVIF_BRANDS:
+            return 'avif'
+        if major in HEIF_BRANDS or brands & (HEIC_BRANDS | HEIF_BRANDS):
+            return 'heic'
+    return None
+
+
+def pillow_feature(name):
+    try:
+        return features.check(name)
+    except ValueError:
+        # unknown to this Pillow version
+        return False
+
+
+def load_plugin(module_name, register=None):
+    """
+    :param module_name: Pillow plugin module to import
+    :param register: name of the module function which registers the decoder, if importing is not enough
+    :return: True if loaded
+    """
+    try:
+        module = importlib.import_module(module_name)
+        if register:
+            getattr(module, register)()
+        return True
+    except Exception:
+        return False
+
+
+# {format name: function returning True if the decoder is available}; called once, the first time needed
+DECODERS = {'jpeg': lambda: pillow_feature('jpg'),
+            'png': lambda: pillow_feature('zlib'),
+            'webp': lambda: pillow_feature('webp'),
+            'avif': lambda: pillow_feature('avif') or load_plugin('pillow_avif'),
+            'tiff': lambda: True,
+            'bmp': lambda: True,
+            'heic': lambda: load_plugin('pillow_heif', 'register_heif_opener')}
+
+# {format name: True / False}
+decoders_loaded = {}
+
+
+def decoder_available(name):
+    """
+    :param name: format name
+    :return: True if pictures of the format can be decoded; plugins get loaded on the first call
+    """
+    if name not in decoders_loaded:
+        decoders_loaded[name] = DECODERS[name]()
+    return decoders_loaded[name]
+
+
+def shrink_on_load(img, size):
+    """
+    Shrinks the just opened (not yet loaded) image to the smallest size not lower than `size`, before the (slow)
+    resampling takes place. JPEG files are decoded by libjpeg at 1/2, 1/4 or 1/8 scale, other formats get reduced
+    by an integer factor.
+    :param img: PIL.Image as returned by Image.open
+    :param size: (width, height) tuple we're going to create the thumbnail of
+    :return: PIL.Image
+    """
+    if img.format == 'JPEG':
+        img.draft(None, size)
+    elif hasattr(img, 'reduce'):
+        # Pillow >= 7.0
+        factor = min(img.size[0] // size[0], img.size[1] // size[1])
+        if factor > 1:
+            img = img.reduce(factor)
+    return img
+
+
+class PillowBackend(object):
+    name = 'pillow'
+
+    def thumbnail(self, img, path, size, fast=True):
+        """
+        :param img: PIL.Image as returned by Image.open
+        :param path: picture path
+        :param size: (width, height) of the box the thumbnail must fit in
+        :param fast: shrink the picture on load
+        :return: PIL.Image
+        """
+        if fast:
+            img = shrink_on_load(img, size)
+        img.thumbnail(size, Image.LANCZOS)
+        return img
+
+    def scale_and_crop(self, path, width, height, out_path):
+        """
+        Scales the picture to cover width x height, crops margins off and saves the result
+        """
+        img = Image.open(path)
+
+        # We can either scale vertically & crop horizontally or scale horizontally and crop vertically
+        new_height = int(img.size[0] * height / width)
+
+        if new_height < img.size[1]:  # we need to scale to display width and crop vertical margins
+            new_height = int(width * img.size[1] / img.size[0])
+            # Choose the filter depending on if we're scaling down or up
+            if new_height >= height:
+                img = img.resize((width, new_height), Image.LANCZOS)
+            else:
+                img = img.resize((width, new_height), Image.BILINEAR)
+
+            margin = (img.size[1] - height) // 2
+            img = img.crop((0, margin, width, height + margin))
+
+        elif new_height > img.size[1]:  # we need to scale to display height and crop horizontal margins
+            new_width = int(img.size[0] * height / img.size[1])
+            if new_width >= width:
+                img = img.resize((new_width, height), Image.LANCZOS)
+            else:
+                img = img.resize((new_width, height), Image.BILINEAR)
+
+            margin = (img.size[0] - width) // 2
+            img = img.crop((margin, 0, width + margin, height))
+
+        else:
+            img = img.resize((width, height), Image.LANCZOS)
+
+        img.save(out_path)
+
+    def flip(self, path, out_path, size):
+        """
+        Saves the horizontally flipped picture as PNG
+        :param size: (width, height) of the box the thumbnail must fit in
+        :return: PIL.Image thumbnail of the flipped picture
+        """
+        flipped = Image.open(path).transpose(Image.FLIP_LEFT_RIGHT)
+        flipped.save(out_path, "PNG")
+        flipped.thumbnail(size, Image.LANCZOS)
+        return flipped
+
+    def split(self, path, boxes, out_paths, size):
+        """
+        Saves parts of the picture as PNG
+        :param boxes: list of (left, upper, right, lower) tuples
+        :param out_paths: list of paths to save parts to
+        :param size: (width, height) of the box thumbnails must fit in
+        :return: list of PIL.Image thumbnails of parts
+        """
+        img = Image.open(path)
+        thumbnails = []
+        for box, out_path in zip(boxes, out_paths):
+            part = img.crop(box)
+            part.save(out_path, "PNG")
+            part.thumbnail(size, Image.LANCZOS)
+            thumbnails.append(part)
+        return thumbnails
+
+    def size(self, path):
+        with Image.open(path) as img:
+            return img.size
+
+
+class VipsBackend(PillowBackend):
+    name = 'vips'
+
+    def thumbnail(self, img, path, size, fast=True):
+        try:
+            if fast:
+                # shrinks on load whatever the format; EXIF orientation ignored, as with Pillow
+                image = pyvips.Image.thumbnail(path, size[0], height=size[1], size='down', no_rotate=True)
+            else:
+                image = pyvips.Image.new_from_file(path).thumbnail_image(size[0], height=size[1], size='down',
+                                                                         no_rotate=True)
+        except pyvips.Error:
+            # e.g. libvips built w/o the loader of the format; the Pillow plugin may do
+            return super().thumbnail(img, path, size, fast)
+        return to_pil(image)
+
+    def scale_and_crop(self, path, width, height, out_path):
+        image = pyvips.Image.thumbnail(path, width, height=height, size='both', crop='centre', no_rotate=True)
+        image.write_to_file(out_path)
+
+    def flip(self, path, out_path, size):
+        pyvips.Image.new_from_file(path).fliphor().write_to_file(out_path)
+        return to_pil(pyvips.Image.thumbnail(out_path, size[0], height=size[1], size='down'))
+
+    def split(self, path, boxes, out_paths, size):
+        image = pyvips.Image.new_from_file(path)
+        thumbnails = []
+        for box, out_path in zip(boxes, out_paths):
+            image.crop(box[0], box[1], box[2] - box[0], box[3] - box[1]).write_to_file(out_path)
+            thumbnails.append(to_pil(pyvips.Image.thumbnail(out_path, size[0], height=size[1], size='down')))
+        return thumbnails
+
+    def size(self, path):
+        # reads the header only
+        image = pyvips.Image.new_from_file(path)
+        return image.width, image.height
+
+
+def to_pil(image):
+    """
+    :param image: pyvips.Image
+    :return: PIL.Image of 8-bit sRGB (or grey) pixels, alpha included
+    """
+    if image.interpretation not in ['srgb', 'b-w']:
+        image = image.colourspace('srgb')
+    if image.format != 'uchar':
+        image = image.cast('uchar')
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[image.bands]
+    return Image.frombytes(mode, (image.width, image.height), image.write_to_memory())
+
+
+def get_backend(name):
+    """
+    :param name: 'auto' (libvips if available), 'vips' or 'pillow'
+    :return: backend object, or None if libvips asked for, but not available
+    """
+    if name == 'pillow' or (name == 'auto' and not pyvips):
+        return PillowBackend()
+    return VipsBackend() if pyvips else None
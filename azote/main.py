@@ -16,10 +16,15 @@ import sys
 import subprocess
 import stat
 import common
+
+# Pre-warming the thumbnail cache needs no GTK, nor a display: let's run it in a process of its own, before loading GTK
+if __name__ == "__main__" and [arg for arg in sys.argv[1:] if arg.upper() in ['-P', '--PREWARM']]:
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prewarm.py')] +
+             sys.argv[1:])
+
 import gi
 import pkg_resources
 import cairo
-from PIL import Image
 
 # send2trash module may or may not be available
 try:
@@ -35,9 +40,11 @@ from colorthief import ColorThief
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GdkPixbuf, Gdk, GLib
 from gi.repository.GdkPixbuf import InterpType
-from tools import set_env, hash_name, create_thumbnails, file_allowed, update_status_bar, flip_selected_wallpaper, \
-    copy_backgrounds, create_pixbuf, split_selected_wallpaper, scale_and_crop, clear_thumbnails, current_display, \
-    save_json, load_json
+from tools import set_env, start_thumbnails, cancel_thumbnails, reprioritize_thumbnails, FolderScan, \
+    update_status_bar, flip_selected_wallpaper, copy_backgrounds, create_pixbuf, split_selected_wallpaper, \
+    scale_and_crop, clear_thumbnails, current_display, save_json, load_json, thumbnail_path, image_dimensions, \
+    pyramid_thumbnail, start_garbage_collector, packed_pixbuf, benchmark_thumbnails, picture_palette, \
+    placeholder_pixbuf, picture_format, archive_member, extract_wallpaper, open_thumbnail_pack
 from color_tools import rgba_to_hex, hex_to_rgb, rgb_to_hex, rgb_to_rgba
 from plugins import Alacritty, Xresources
 from color_tools import WikiColours
@@ -53,24 +60,26 @@ except:
 
 
 def get_files():
+    """
+    :return: (list of picture paths relative to the source folder, FolderScan object) tuple
+    """
     try:
-        file_names = [f for f in os.listdir(common.settings.src_path)
-                      if os.path.isfile(os.path.join(common.settings.src_path, f))]
+        scan = FolderScan(common.settings.src_path)
     except FileNotFoundError:
         common.settings.src_path = os.getenv('HOME')
-        file_names = [f for f in os.listdir(common.settings.src_path)
-                      if os.path.isfile(os.path.join(common.settings.src_path, f))]
+        scan = FolderScan(common.settings.src_path)
+    pictures = [(os.path.relpath(path, common.settings.src_path), path, st) for path, st in scan.pictures]
 
     if common.settings.sorting == 'new':
-        file_names.sort(reverse=True, key=lambda f: os.path.getmtime(os.path.join(common.settings.src_path, f)))
+        pictures.sort(reverse=True, key=lambda p: scan.mtime(p[1], p[2]))
     elif common.settings.sorting == 'old':
-        file_names.sort(key=lambda f: os.path.getmtime(os.path.join(common.settings.src_path, f)))
+        pictures.sort(key=lambda p: scan.mtime(p[1], p[2]))
     elif common.settings.sorting == 'az':
-        file_names.sort()
+        pictures.sort()
     elif common.settings.sorting == 'za':
-        file_names.sort(reverse=True)
+        pictures.sort(reverse=True)
 
-    return file_names
+    return [p[0] for p in pictures], scan
 
 
 class Preview(Gtk.ScrolledWindow):
@@ -82,46 +91,124 @@ class Preview(Gtk.ScrolledWindow):
         self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.ALWAYS)
 
         common.thumbnails_list = []
+        self.thumbnails = {}  # {source path: Thumbnail}
+        self.positions = {}  # {source path: position in the grid}
+        # Area of the grid (top, bottom) which thumbnails are being created first
+        self.priority_area = None
+        self.reprioritize_id = None
+        self.get_vadjustment().connect('value-changed', self.on_scroll)
         self.grid = Gtk.FlowBox()
         self.grid.set_valign(Gtk.Align.START)
         # self.grid.set_max_children_per_line(30)
         self.grid.set_selection_mode(Gtk.SelectionMode.NONE)
 
-        create_thumbnails(common.settings.src_path)
-        self.files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
-
-        src_pictures = get_files()
-
-        for file in src_pictures:
-            if file_allowed(file):
-                thumbnail = Thumbnail(common.settings.src_path, file)
-                common.thumbnails_list.append(thumbnail)
-                self.grid.add(thumbnail)
+        # Thumbnails get created once the window shows up
+        self.fill_grid()
 
         self.add(self.grid)
 
-    def refresh(self, create_thumbs=True):
-        self.files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
-
-        if create_thumbs:
-            create_thumbnails(common.settings.src_path)
+    def fill_grid(self):
+        """
+        Shows thumbnails available, and placeholders of these yet to be created
+        """
+        common.thumb_index.load(common.settings.src_path)
+        # thumbnails get read from the pack, if any, while building the grid
+        if common.settings.packed_thumbnails:
+            open_thumbnail_pack(common.settings.src_path)
 
         for thumbnail in common.thumbnails_list:
             self.grid.remove(thumbnail)
             thumbnail.destroy()
+        common.thumbnails_list = []
+        self.thumbnails = {}
+        self.positions = {}
 
-        src_pictures = get_files()
+        # shared with creating thumbnails, and tracking changes by mtime of directories
+        src_pictures, self.scan = get_files()
 
         for file in src_pictures:
-            if file_allowed(file):
-                thumbnail = Thumbnail(common.settings.src_path, file)
-                common.thumbnails_list.append(thumbnail)
-                self.grid.add(thumbnail)
+            # pictures of subfolders, if scanned recursively
+            folder, filename = os.path.split(os.path.join(common.settings.src_path, file))
+            thumbnail = Thumbnail(folder, filename)
+            common.thumbnails_list.append(thumbnail)
+            self.thumbnails[thumbnail.source_path] = thumbnail
+            self.positions[thumbnail.source_path] = len(self.positions)
+            self.grid.add(thumbnail)
+
+            thumbnail.show_all()
+            thumbnail.toolbar.hide()
+
+    def create_thumbnails(self):
+        # in the background; placeholders get replaced as thumbnails arrive
+        self.update_priority_area()
+        start_thumbnails(common.settings.src_path, self.on_thumbnail_created, update_status_bar,
+                         self.thumbnail_priority, self.scan)
+        return False
+
+    def update_priority_area(self):
+        """
+        Grid positions (first, last + 1) of the visible part of the grid, with a page below and a half above; counted
+        out of the scroll position and the size of the first thumbnail, w/o looking at every single one
+        """
+        self.priority_area = None
+        child = common.thumbnails_list[0].get_parent() if common.thumbnails_list else None
+        allocation = child.get_allocation() if child else None
+        # not allocated until the grid shows up
+        if allocation and allocation.height > 1:
+            adjustment = self.get_vadjustment()
+            page = adjustment.get_page_size()
+            row = allocation.height + self.grid.get_row_spacing()
+            column = allocation.width + self.grid.get_column_spacing()
+            columns = max((self.grid.get_allocated_width() + self.grid.get_column_spacing()) // column, 1)
+            first = max(int((adjustment.get_value() - page / 2) // row), 0)
+            last = int((adjustment.get_value() + page * 2) // row) + 1
+            self.priority_area = first * columns, last * columns
+
+    def thumbnail_priority(self, source_path):
+        """
+        Thumbnails in and around the visible area go first, the rest in order of the grid (or of the disk layout, see
+        scan_thumbnails)
+        """
+        position = self.positions.get(source_path, len(self.positions))
+        if self.priority_area and self.priority_area[0] <= position < self.priority_area[1]:
+            return 0, position
+        return 1, position
+
+    def on_scroll(self, adjustment):
+        # reorder at most 10 times per second
+        if not self.reprioritize_id:
+            self.reprioritize_id = GLib.timeout_add(100, self.reprioritize)
+
+    def reprioritize(self):
+        self.reprioritize_id = None
+        previous = self.priority_area
+        self.update_priority_area()
+        if self.priority_area != previous:
+            # only thumbnails entering or leaving the area
+            paths = []
+            for area in [previous, self.priority_area]:
+                if area:
+                    paths += [thumbnail.source_path for thumbnail in common.thumbnails_list[area[0]:area[1]]]
+            reprioritize_thumbnails(paths)
+        return False
+
+    def on_thumbnail_created(self, source_path, thumb_name):
+        thumbnail = self.thumbnails.get(source_path)
+        if thumbnail:
+            if thumb_name:
+                thumbnail.thumb_file = os.path.join(common.thumb_dir, thumb_name)
+                thumbnail.show_thumbnail(packed=False)
+            else:
+                thumbnail.show_broken()
 
-                thumbnail.show_all()
-                thumbnail.toolbar.hide()
+    def refresh(self, create_thumbs=True):
+        cancel_thumbnails()
+        self.fill_grid()
 
-        update_status_bar()
+        if create_thumbs:
+            self.create_thumbnails()
+        else:
+            update_status_bar()
 
 
 class Thumbnail(Gtk.VBox):
@@ -139,8 +226,14 @@ class Thumbnail(Gtk.VBox):
         self.source_path = os.path.join(folder, filename)
 
         self.img = Gtk.Image()
-        self.thumb_file = "{}.png".format(os.path.join(common.thumb_dir, hash_name(self.source_path)))
-        self.img.set_from_file(self.thumb_file)
+        letterbox(self.img)
+        self.thumb_file = thumbnail_path(self.source_path, placeholder=True)
+        if common.thumb_index.broken(self.source_path):
+            self.show_broken()
+        elif os.path.isfile(self.thumb_file):
+            self.show_thumbnail()
+        else:
+            self.show_placeholder()
 
         self.image_button.set_image(self.img)
         self.image_button.set_image_position(2)  # TOP
@@ -156,6 +249,36 @@ class Thumbnail(Gtk.VBox):
 
         self.add(self.image_button)
 
+    def show_thumbnail(self, packed=True):
+        """
+        :param packed: read from the packed store, if available; not if the thumbnail has just been (re)created
+        """
+        # On HiDPI displays use a bigger pyramid level, if available
+        scale = common.main_window.get_scale_factor() if common.main_window else 1
+        level = pyramid_thumbnail(os.path.basename(self.thumb_file),
+                                  (common.settings.thumb_width * scale, common.settings.thumb_height * scale),
+                                  path_only=True) if scale > 1 else None
+        packed = packed_pixbuf(os.path.basename(self.thumb_file)) if packed and not level else None
+        if level:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(level, common.settings.thumb_width * scale,
+                                                             common.settings.thumb_height * scale, True)
+            self.img.set_from_surface(Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, None))
+        elif packed:
+            self.img.set_from_pixbuf(packed)
+        else:
+            self.img.set_from_file(self.thumb_file)
+
+    def show_placeholder(self):
+        # Colour grid stored in the index, if the picture has ever been decoded
+        data = common.thumb_index.placeholder(self.source_path)
+        dimensions = common.thumb_index.dimensions(self.source_path)
+        if data and dimensions:
+            self.img.set_from_pixbuf(placeholder_pixbuf(data, dimensions))
+
+    def show_broken(self):
+        # failed to decode, and not retried until the file changes
+        self.img.set_from_icon_name('image-missing', Gtk.IconSize.DIALOG)
+
     def on_image_button_press(self, button, event):
 
         self.select(button)
@@ -181,11 +304,14 @@ class Thumbnail(Gtk.VBox):
             self.toolbar.show_all()
         thumbnail.set_property("name", "thumb-btn-selected")
 
-        with Image.open(self.source_path) as img:
-            filename = self.filename
-            if len(filename) > 30:
-                filename = '…{}'.format(filename[-28::])
-            common.selected_picture_label.set_text("{} ({} x {})".format(filename, img.size[0], img.size[1]))
+        dimensions = image_dimensions(self.source_path)
+        filename = self.filename
+        if len(filename) > 30:
+            filename = '…{}'.format(filename[-28::])
+        if dimensions:
+            common.selected_picture_label.set_text("{} ({} x {})".format(filename, *dimensions))
+        else:
+            common.selected_picture_label.set_text(filename)
 
     def deselect(self, thumbnail):
         self.selected = False
@@ -193,6 +319,38 @@ class Thumbnail(Gtk.VBox):
         thumbnail.image_button.set_property("name", "thumb-btn")
 
 
+def letterbox(image):
+    """
+    Thumbnails are stored at their natural proportion. Let's keep the image widget of the thumbnail size,
+    and draw the checkered background behind the picture.
+    """
+    image.set_size_request(common.settings.thumb_width, common.settings.thumb_height)
+    image.connect('draw', draw_checkerboard)
+
+
+def draw_checkerboard(widget, context):
+    if not common.checkerboard:
+        # 8 px grey squares, as thumbnails used to be pasted on
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, 16, 16)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(0.467, 0.467, 0.467)
+        ctx.paint()
+        ctx.set_source_rgb(0.643, 0.643, 0.643)
+        ctx.rectangle(0, 0, 8, 8)
+        ctx.rectangle(8, 8, 8, 8)
+        ctx.fill()
+        common.checkerboard = cairo.SurfacePattern(surface)
+        common.checkerboard.set_extend(cairo.EXTEND_REPEAT)
+
+    width, height = common.settings.thumb_size
+    context.rectangle((widget.get_allocated_width() - width) // 2, (widget.get_allocated_height() - height) // 2,
+                      width, height)
+    context.set_source(common.checkerboard)
+    context.fill()
+    # let the image draw itself on top
+    return False
+
+
 def deselect_all():
     for thumbnail in common.thumbnails_list:
         thumbnail.deselect(thumbnail)
@@ -240,12 +398,15 @@ class DisplayBox(Gtk.Box):
         self.include = True
 
         if thumb and os.path.isfile(thumb):
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumb)
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(thumb, common.settings.thumb_size[0],
+                                                             common.settings.thumb_size[1], True)
         else:
             pixbuf = GdkPixbuf.Pixbuf.new_from_file('images/empty.png')
-        pixbuf = pixbuf.scale_simple(common.settings.thumb_size[0], common.settings.thumb_size[1], InterpType.BILINEAR)
+            pixbuf = pixbuf.scale_simple(common.settings.thumb_size[0], common.settings.thumb_size[1],
+                                         InterpType.BILINEAR)
 
         self.img = Gtk.Image.new_from_pixbuf(pixbuf)
+        letterbox(self.img)
 
         if path is None:
             self.img_selected = False
@@ -380,6 +541,8 @@ class DisplayBox(Gtk.Box):
     def on_flip_button(self, button):
         # convert images and get (thumbnail path, flipped image path)
         images = flip_selected_wallpaper()
+        if not images:
+            return
         self.img.set_from_file(images[0])
         self.wallpaper_path = images[1]
         self.thumbnail_path = images[0]
@@ -459,6 +622,13 @@ def on_apply_button(button):
     """
     Create the command for swaybg (Sway) or feh (X11)
     """
+    # Members of archives get extracted to the backgrounds folder, as swaybg / feh need real files
+    for box in common.display_boxes_list:
+        if box.wallpaper_path and archive_member(box.wallpaper_path):
+            extracted = extract_wallpaper(box.wallpaper_path)
+            if extracted:
+                box.wallpaper_path = extracted
+
     # Copy modified wallpapers (if any) from temporary to backgrounds folder
     copy_backgrounds()
 
@@ -501,9 +671,11 @@ def on_apply_button(button):
                     thumb = "thumb-part{}".format(box.wallpaper_path.split("part")[1])
                     thumb = os.path.join(common.data_home, "backgrounds-sway", thumb)
 
+                elif os.path.basename(box.wallpaper_path).startswith("archived-"):
+                    thumb = box.thumbnail_path
+
                 else:
-                    thumb = "{}.png".format(hash_name(box.wallpaper_path))
-                    thumb = os.path.join(common.data_home, "thumbnails", thumb)
+                    thumb = thumbnail_path(box.wallpaper_path)
 
                 entry = {"name": display_name, "path": box.wallpaper_path, "thumb": thumb}
                 restore_from.append(entry)
@@ -545,9 +717,11 @@ def on_apply_button(button):
                 thumb = "thumb-part{}".format(box.wallpaper_path.split("part")[1])
                 thumb = os.path.join(common.data_home, "backgrounds-feh", thumb)
 
+            elif os.path.basename(box.wallpaper_path).startswith("archived-"):
+                thumb = box.thumbnail_path
+
             else:
-                thumb = "{}.png".format(hash_name(box.wallpaper_path))
-                thumb = os.path.join(common.data_home, "thumbnails", thumb)
+                thumb = thumbnail_path(box.wallpaper_path)
 
             entry = {"name": box.display_name, "path": box.wallpaper_path,
                      "thumb": thumb}
@@ -566,6 +740,8 @@ def on_split_button(button):
             if item.include:
                 num_parts += 1
         paths = split_selected_wallpaper(num_parts)
+        if not paths:
+            return
         i = 0
         for box in common.display_boxes_list:
             if box.include:
@@ -581,15 +757,21 @@ def on_split_button(button):
 
 
 def open_with(item, opener):
+    source_path, folder = common.selected_wallpaper.source_path, common.selected_wallpaper.folder
+    member = archive_member(source_path)
+    if member:
+        # viewers need a real file; feh saves next to the archive
+        source_path, folder = extract_wallpaper(source_path), os.path.dirname(member[0])
+        if not source_path:
+            return
     # if feh selected as the opener, let's start it with options as below
     if opener == 'feh':
-        command = 'feh --start-at "{}" --scale-down --no-fehbg -d --output-dir {}'.format(
-            common.selected_wallpaper.source_path, common.selected_wallpaper.folder)
+        command = 'feh --start-at "{}" --scale-down --no-fehbg -d --output-dir {}'.format(source_path, folder)
     # elif could specify options for other certain programs here
     elif opener == 'swappy':
-        command = 'swappy -f {}'.format(common.selected_wallpaper.source_path)
+        command = 'swappy -f {}'.format(source_path)
     else:
-        command = '{} "{}"'.format(opener, common.selected_wallpaper.source_path)
+        command = '{} "{}"'.format(opener, source_path)
     subprocess.Popen(command, shell=True)
 
 
@@ -656,7 +838,7 @@ def show_image_menu(widget, event=None, parent=None, from_toolbar=False):
     cd = current_display()
     if common.selected_wallpaper:
         if common.associations:  # not None if /usr/share/applications/mimeinfo.cache found and parse
-            openers = common.associations[common.selected_wallpaper.source_path.split('.')[-1]]
+            openers = common.associations.get(picture_format(common.selected_wallpaper.source_path))
             menu = Gtk.Menu()
             if openers:
                 for opener in openers:
@@ -759,7 +941,8 @@ def show_image_menu(widget, event=None, parent=None, from_toolbar=False):
 
             item.set_submenu(submenu)
 
-            if common.env['send2trash']:
+            # members of archives can't be trashed one by one
+            if common.env['send2trash'] and not archive_member(common.selected_wallpaper.source_path):
                 item = Gtk.SeparatorMenuItem()
                 menu.append(item)
                 item = Gtk.MenuItem.new_with_label(common.lang['remove_image'])
@@ -777,9 +960,7 @@ def show_image_menu(widget, event=None, parent=None, from_toolbar=False):
 
         else:  # fallback in case mimeinfo.cache not found
             print("No registered program found. Does the /usr/share/applications/mimeinfo.cache file exist?")
-            command = 'feh --start-at {} --scale-down --no-fehbg -d --output-dir {}'.format(
-                common.selected_wallpaper.source_path, common.selected_wallpaper.folder)
-            subprocess.Popen(command, shell=True)
+            open_with(None, 'feh')
 
 
 def on_refresh_clicked(button):
@@ -788,9 +969,9 @@ def on_refresh_clicked(button):
 
 
 def generate_palette(item, thumb_file, filename, image_path, num_colors):
-    color_thief = ColorThief(image_path)
-    # dominant = color_thief.get_color(quality=10)
-    palette = color_thief.get_palette(color_count=num_colors, quality=common.settings.palette_quality)
+    palette = picture_palette(image_path, num_colors)
+    if not palette:
+        return
     if common.cpd:
         common.cpd.close()
     common.cpd = ColorPaletteDialog(thumb_file, filename, palette)
@@ -1074,6 +1255,8 @@ class GUI:
 
         window.show_all()
         deselect_all()
+        # The grid shows placeholders until thumbnails get created
+        GLib.idle_add(common.preview.create_thumbnails)
 
         common.progress_bar.hide()
 
@@ -1764,15 +1947,15 @@ def print_help():
     print('\nAzote wallpaper manager version {}\n'.format(version))
     print('[-h] | [--help]\t\t\t Print help')
     print('[-l] | [--lang] <ln_LN> \t Force a locale (de_DE, en_EN, fr_FR, pl_PL)')
-    print('[-c] | [--clear]\t\t Clear unused thumbnails')
-    print('[-a] | [--clear-all]\t\t Clear all thumbnails\n')
+    print('[-c] | [--clear]\t\t Clear unused thumbnails (of deleted pictures and folders not browsed recently)')
+    print('[-a] | [--clear-all]\t\t Clear all thumbnails')
+    print('[-b] | [--benchmark] [<dir>]\t Compare thumbnail encodings on pictures in the current or given folder')
+    print('[-p] | [--prewarm] [<dir>...]\t Create thumbnails and palettes of the current or given folders, w/o GUI\n')
 
 
 def track_changes():
-    if common.preview and common.settings.src_path:
-        files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
-        if not files_dict == common.preview.files_dict:
-            common.preview.refresh()
+    if common.preview and common.settings.src_path and common.preview.scan.changed():
+        common.preview.refresh()
     return common.settings.track_files
 
 
@@ -1833,6 +2016,7 @@ class Indicator(object):
 def main():
     lang = None
     clear_thumbs, clear_all = False, False
+    benchmark, benchmark_dir = False, None
     common.color_names = WikiColours()
     for i in range(1, len(sys.argv)):
         if sys.argv[i].upper() == '-H' or sys.argv[i].upper() == '--HELP':
@@ -1851,6 +2035,12 @@ def main():
         if sys.argv[i].upper() == '-A' or sys.argv[i].upper() == '--CLEAR-ALL':
             clear_thumbs, clear_all = True, True
 
+        if sys.argv[i].upper() == '-B' or sys.argv[i].upper() == '--BENCHMARK':
+            benchmark = True
+            if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('-'):
+                # the launcher changes the working directory
+                benchmark_dir = os.path.join(os.getenv('AZOTE_CWD', os.getcwd()), sys.argv[i + 1])
+
     screen = Gdk.Screen.get_default()
     provider = Gtk.CssProvider()
     style_context = Gtk.StyleContext()
@@ -1934,6 +2124,10 @@ def main():
         clear_thumbnails(clear_all)
         exit()
 
+    if benchmark:
+        benchmark_thumbnails(benchmark_dir if benchmark_dir else common.settings.src_path)
+        exit()
+
     common.cols = len(common.displays) if len(common.displays) > common.settings.columns else common.settings.columns
 
     if common.settings.track_files:
@@ -1941,6 +2135,9 @@ def main():
     if common.env['app_indicator']:
         common.indicator = Indicator()
 
+    # Delete thumbnails no longer in use in the background, when the GUI is up and running
+    GLib.timeout_add_seconds(10, start_garbage_collector)
+
     # We want Azote to take all the possible screen height. Since Gdk.Screen.height is deprecated, we need to measure
     # the current screen height in another way. `w` is a temporary window.
     # If on sway, we've already detected the screen height in tools/check_displays() and stored it in common.screen_h
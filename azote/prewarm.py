@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpaper manager for Sway, i3 and some other WMs, as a frontend to swaybg and feh
+
+Headless thumbnail cache pre-warming: `azote --prewarm [DIR...]` creates thumbnails, index records and colour
+palettes of pictures in the given folders (or the current one), at idle CPU and I/O priority, w/o loading GTK.
+Everything done gets indexed as it goes, so an interrupted run continues where it stopped next time.
+
+Author: Piotr Miller
+e-mail: nwg.piotr@gmail.com
+Website: http://nwg.pl
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import os
+import signal
+import subprocess
+import sys
+
+import common
+
+# tools must not load GTK
+common.headless = True
+
+from tools import set_headless_env, create_thumbnails, prewarm_palettes, log
+
+
+def set_idle_priority():
+    os.nice(19)
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError) as e:
+        log('Failed setting SCHED_IDLE - {}'.format(e), common.WARNING)
+    # the 'idle' I/O scheduling class; inherited by sandbox processes, as well as the above
+    try:
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=True, stdout=subprocess.DEVNULL)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        log('Failed setting idle I/O priority - {}'.format(e), common.WARNING)
+
+
+def folders_given():
+    folders, collecting = [], False
+    for arg in sys.argv[1:]:
+        if arg.upper() in ['-P', '--PREWARM']:
+            collecting = True
+        elif arg.startswith('-'):
+            collecting = False
+        elif collecting:
+            # the launcher changes the working directory
+            folders.append(os.path.abspath(os.path.join(os.getenv('AZOTE_CWD', os.getcwd()), arg)))
+    return folders
+
+
+def main():
+    # let's index what's been done so far, on `systemctl stop` as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    set_headless_env()
+    set_idle_priority()
+
+    folders = folders_given()
+    if not folders:
+        folders = [common.settings.src_path]
+    try:
+        for folder in folders:
+            if not os.path.isdir(folder):
+                print('Azote: {} is not a folder'.format(folder))
+                continue
+            created = []
+            create_thumbnails(folder, lambda path, thumb_name: created.append(thumb_name))
+            palettes = prewarm_palettes(folder)
+            # no thumbnail name if the picture failed to decode
+            thumbnails = len([thumb_name for thumb_name in created if thumb_name])
+            print('Azote: {} - {} thumbnails created, palettes of {} pictures generated'.format(
+                folder, thumbnails, palettes))
+            log('Pre-warmed {}: {} thumbnails, {} palettes'.format(folder, thumbnails, palettes), common.INFO)
+    except KeyboardInterrupt:
+        print('\nAzote: interrupted, run again to continue')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
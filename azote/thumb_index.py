@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpaper manager for Sway, i3 and some other WMs, as a frontend to swaybg and feh
+
+Persistent index of source pictures and their thumbnails, stored in an SQLite database in common.data_home.
+It lets us tell if a thumbnail is up to date with a single query per folder, instead of stat-ing and hashing
+every single file. Pictures we failed to decode are indexed with no thumbnail, not to be retried until changed.
+
+Author: Piotr Miller
+e-mail: nwg.piotr@gmail.com
+Website: http://nwg.pl
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import json
+import os
+import sqlite3
+import time
+
+# Results of the single decode pass, besides dimensions: see tools.picture_features()
+FEATURES = ('placeholder', 'histogram', 'phash', 'luminance', 'colourfulness')
+
+COLUMNS = ('path', 'folder', 'size', 'mtime', 'inode', 'thumb', 'width', 'height', 'format') + FEATURES
+
+# Columns which survive storing the picture again, as long as it has not changed
+KEPT = ('palettes', 'quarantine')
+UNCHANGED = 'files.size = excluded.size AND files.mtime = excluded.mtime AND files.inode = excluded.inode'
+
+
+def dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class ThumbnailIndex(object):
+    def __init__(self, db_file):
+        self.db = sqlite3.connect(db_file)
+        self.db.row_factory = dict_factory
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               folder TEXT NOT NULL,
+                               size INTEGER,
+                               mtime INTEGER,
+                               inode INTEGER,
+                               thumb TEXT,
+                               width INTEGER,
+                               height INTEGER)""")
+        # Columns added later: reason why the picture must not be decoded again until changed, if exceeded decoding
+        # limits; tiny colour grid to show until the thumbnail loads; json of colour palettes generated; colour
+        # histogram to generate palettes of, perceptual hash and statistics of the picture; format told by the header
+        columns = [row['name'] for row in self.db.execute("PRAGMA table_info(files)")]
+        for column, column_type in [('quarantine', 'TEXT'), ('placeholder', 'BLOB'), ('palettes', 'TEXT'),
+                                    ('histogram', 'BLOB'), ('phash', 'TEXT'), ('luminance', 'REAL'),
+                                    ('colourfulness', 'REAL'), ('format', 'TEXT')]:
+            if column not in columns:
+                self.db.execute("ALTER TABLE files ADD COLUMN {} {}".format(column, column_type))
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_folder ON files (folder)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_thumb ON files (thumb)")
+        # thumbnail files (shared by files of the same content, if named after it)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS thumbs (
+                               thumb TEXT PRIMARY KEY,
+                               bytes INTEGER,
+                               accessed REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS thumbs_accessed ON thumbs (accessed)")
+        # source folders and when they were browsed last time
+        self.db.execute("""CREATE TABLE IF NOT EXISTS folders (
+                               folder TEXT PRIMARY KEY,
+                               accessed REAL)""")
+        # directories of folders scanned recursively: json lists of subdirectory and picture names, as of mtime
+        self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                               folder TEXT NOT NULL,
+                               path TEXT NOT NULL,
+                               mtime INTEGER,
+                               subdirs TEXT,
+                               files TEXT,
+                               PRIMARY KEY (folder, path))""")
+        # archives browsed as folders: json list of picture member records (see archives.list_members), as of size
+        # and mtime of the archive file
+        self.db.execute("""CREATE TABLE IF NOT EXISTS archives (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime INTEGER,
+                               kind TEXT,
+                               members TEXT)""")
+        self.db.commit()
+
+        # records of the last folder loaded, {path: {column: value}}
+        self.records = {}
+
+        # running totals of the thumbnail cache, for the status bar not to walk the cache folder
+        row = self.db.execute("SELECT COUNT(*) AS count, TOTAL(bytes) AS bytes FROM thumbs").fetchone()
+        self.count, self.bytes = row['count'], int(row['bytes'])
+
+    def load(self, folder):
+        """
+        :param folder: source folder path
+        :return: {path: record} dictionary of all the pictures indexed in the folder
+        """
+        cursor = self.db.execute("SELECT * FROM files WHERE folder = ?", (folder,))
+        self.records = {row['path']: row for row in cursor}
+        return self.records
+
+    def is_current(self, path, stat_result):
+        """
+        :param path: source file path
+        :param stat_result: os.stat_result of the source file
+        :return: True if the file has been indexed and not changed since
+        """
+        record = self.records.get(path)
+        return record is not None and record['size'] == stat_result.st_size and \
+            record['mtime'] == stat_result.st_mtime_ns and record['inode'] == stat_result.st_ino
+
+    def store(self, folder, entries, formats=None):
+        """
+        :param folder: source folder path
+        :param entries: list of (path, os.stat_result, thumbnail name or None if failed, (width, height) or None,
+        {feature: value} dictionary or None) tuples
+        :param formats: {path: picture format name}
+        """
+        formats = formats if formats else {}
+        rows = []
+        for path, st, thumb, dimensions, features in entries:
+            width, height = dimensions if dimensions else (None, None)
+            features = features if features else {}
+            rows.append((path, folder, st.st_size, st.st_mtime_ns, st.st_ino, thumb, width, height,
+                         formats.get(path)) + tuple(features.get(feature) for feature in FEATURES))
+        # palettes and the quarantine mark depend on the picture, not on the thumbnail: kept if unchanged
+        self.db.executemany("INSERT INTO files ({}) VALUES ({}) ON CONFLICT(path) DO UPDATE SET {}, {}".format(
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)),
+            ', '.join('{0} = excluded.{0}'.format(column) for column in COLUMNS[1:]),
+            ', '.join('{0} = CASE WHEN {1} THEN files.{0} END'.format(column, UNCHANGED) for column in KEPT)), rows)
+        self.db.commit()
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            previous = self.records.get(row[0])
+            if previous and all(previous[column] == record[column] for column in ['size', 'mtime', 'inode']):
+                record.update({column: previous.get(column) for column in KEPT})
+            self.records[row[0]] = record
+
+    def store_formats(self, formats):
+        """
+        :param formats: {path: picture format name} of pictures indexed before formats were
+        """
+        self.db.executemany("UPDATE files SET format = ? WHERE path = ?", [(name, path) for path, name in
+                                                                          formats.items()])
+        self.db.commit()
+        for path, name in formats.items():
+            if path in self.records:
+                self.records[path]['format'] = name
+
+    def forget(self, paths):
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+        self.db.commit()
+        for path in paths:
+            self.records.pop(path, None)
+
+    def forget_thumbnails(self, thumbs):
+        """
+        Removes records pointing to deleted thumbnail files
+        :param thumbs: thumbnail file names; shared thumbnails may come once per picture
+        """
+        thumbs = set(thumbs)
+        for thumb in thumbs:
+            row = self.db.execute("SELECT bytes FROM thumbs WHERE thumb = ?", (thumb,)).fetchone()
+            if row:
+                self.count -= 1
+                self.bytes -= row['bytes']
+        self.db.executemany("DELETE FROM thumbs WHERE thumb = ?", [(thumb,) for thumb in thumbs])
+        self.db.executemany("DELETE FROM files WHERE thumb = ?", [(thumb,) for thumb in thumbs])
+        self.db.commit()
+        self.records = {path: record for path, record in self.records.items() if record['thumb'] not in thumbs}
+
+    def clear(self):
+        self.db.execute("DELETE FROM files")
+        self.db.execute("DELETE FROM thumbs")
+        self.db.execute("DELETE FROM folders")
+        self.db.execute("DELETE FROM dirs")
+        self.db.execute("DELETE FROM archives")
+        self.db.commit()
+        self.records = {}
+        self.count, self.bytes = 0, 0
+
+    def invalidate(self):
+        """
+        Forgets all thumbnails, but keeps records of pictures outdated, for their data to be used until refreshed
+        """
+        self.db.execute("UPDATE files SET mtime = NULL")
+        self.db.execute("DELETE FROM thumbs")
+        self.db.commit()
+        self.records = {}
+        self.count, self.bytes = 0, 0
+
+    def add_thumbnails(self, sizes, accessed):
+        """
+        :param sizes: {thumbnail file name: bytes on disk}
+        :param accessed: timestamp
+        """
+        for thumb, size in sizes.items():
+            row = self.db.execute("SELECT bytes FROM thumbs WHERE thumb = ?", (thumb,)).fetchone()
+            if row:
+                self.bytes -= row['bytes']
+            else:
+                self.count += 1
+            self.bytes += size
+        self.db.executemany("INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?)",
+                            [(thumb, size, accessed) for thumb, size in sizes.items()])
+        self.db.commit()
+
+    def touch(self, folder, accessed):
+        """
+        Marks the folder, and thumbnails of all the pictures in it as just used
+        """
+        self.db.execute("UPDATE thumbs SET accessed = ? WHERE thumb IN (SELECT thumb FROM files WHERE folder = ?)",
+                        (accessed, folder))
+        self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, accessed))
+        self.db.commit()
+
+    def folders(self, accessed_before=None):
+        """
+        :param accessed_before: timestamp, to only return folders not browsed since
+        :return: list of indexed folders, which no longer exist, or all of them if `accessed_before` not given
+        """
+        # Folders indexed before we started to track access time count as just browsed
+        self.db.execute("INSERT OR IGNORE INTO folders SELECT DISTINCT folder, ? FROM files", (time.time(),))
+        self.db.commit()
+        folders = [row['folder'] for row in self.db.execute("SELECT folder, accessed FROM folders")
+                   if accessed_before is None or row['accessed'] < accessed_before or not os.path.isdir(row['folder'])]
+        return folders
+
+    def folder_paths(self, folder):
+        return [row['path'] for row in self.db.execute("SELECT path FROM files WHERE folder = ?", (folder,))]
+
+    def forget_folder(self, folder):
+        self.db.execute("DELETE FROM files WHERE folder = ?", (folder,))
+        self.db.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+        self.db.execute("DELETE FROM dirs WHERE folder = ?", (folder,))
+        self.db.execute("DELETE FROM archives WHERE path LIKE ?", (os.path.join(folder, '%'),))
+        self.db.commit()
+        if any(record['folder'] == folder for record in self.records.values()):
+            self.records = {}
+
+    def load_dirs(self, folder):
+        """
+        :param folder: source folder path, scanned recursively
+        :return: {directory path: {'mtime': st_mtime_ns, 'subdirs': [names], 'files': [picture names]}}
+        """
+        cursor = self.db.execute("SELECT path, mtime, subdirs, files FROM dirs WHERE folder = ?", (folder,))
+        return {row['path']: {'mtime': row['mtime'], 'subdirs': json.loads(row['subdirs']),
+                              'files': json.loads(row['files'])} for row in cursor}
+
+    def store_dirs(self, folder, listed, gone):
+        """
+        :param folder: source folder path, scanned recursively
+        :param listed: list of (directory path, st_mtime_ns, subdirectory names, picture names) tuples
+        :param gone: paths of directories no longer there
+        """
+        self.db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                            [(folder, path, mtime, json.dumps(subdirs), json.dumps(files)) for
+                             path, mtime, subdirs, files in listed])
+        self.db.executemany("DELETE FROM dirs WHERE folder = ? AND path = ?", [(folder, path) for path in gone])
+        self.db.commit()
+
+    def archive(self, path, stat_result):
+        """
+        :param path: archive path
+        :param stat_result: os.stat_result of the archive
+        :return: (kind, list of member records) tuple, or None if not indexed or the archive has changed since
+        """
+        row = self.db.execute("SELECT size, mtime, kind, members FROM archives WHERE path = ?", (path,)).fetchone()
+        if row and row['size'] == stat_result.st_size and row['mtime'] == stat_result.st_mtime_ns:
+            return row['kind'], json.loads(row['members'])
+        return None
+
+    def store_archive(self, path, stat_result, kind, members):
+        self.db.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)",
+                        (path, stat_result.st_size, stat_result.st_mtime_ns, kind, json.dumps(members)))
+        self.db.commit()
+
+    def forget_archives(self, folder):
+        """
+        Forgets archives of the folder (and of its subfolders) no longer there
+        """
+        paths = [row['path'] for row in self.db.execute("SELECT path FROM archives WHERE path LIKE ?",
+                                                          (os.path.join(folder, '%'),))]
+        self.db.executemany("DELETE FROM archives WHERE path = ?", [(path,) for path in paths
+                                                                      if not os.path.isfile(path)])
+        self.db.commit()
+
+    def referenced_thumbnails(self):
+        """
+        :return: set of thumbnail file names used by indexed pictures
+        """
+        return {row['thumb'] for row in self.db.execute("SELECT DISTINCT thumb FROM files WHERE thumb IS NOT NULL")}
+
+    def known_thumbnails(self):
+        """
+        :return: set of thumbnail file names counted in the cache totals
+        """
+        return {row['thumb'] for row in self.db.execute("SELECT thumb FROM thumbs")}
+
+    def evict(self, max_bytes, max_entries, keep_folder):
+        """
+        Forgets least recently used thumbnails, until the cache fits in limits given
+        :param max_bytes: 0 for no limit
+        :param max_entries: 0 for no limit
+        :param keep_folder: folder which thumbnails must not be evicted
+        :return: list of thumbnail file names to delete
+        """
+        def over_limit():
+            return (max_bytes and self.bytes > max_bytes) or (max_entries and self.count > max_entries)
+
+        evicted = []
+        if not over_limit():
+            return evicted
+        cursor = self.db.execute("SELECT thumb, bytes FROM thumbs WHERE thumb NOT IN "
+                                 "(SELECT thumb FROM files WHERE folder = ? AND thumb IS NOT NULL) ORDER BY accessed",
+                                 (keep_folder,))
+        for row in cursor.fetchall():
+            if not over_limit():
+                break
+            evicted.append(row['thumb'])
+            self.count -= 1
+            self.bytes -= row['bytes']
+        self.db.executemany("DELETE FROM thumbs WHERE thumb = ?", [(thumb,) for thumb in evicted])
+        self.db.executemany("DELETE FROM files WHERE thumb = ?", [(thumb,) for thumb in evicted])
+        self.db.commit()
+        return evicted
+
+    def thumb_name(self, path):
+        record = self.records.get(path)
+        return record['thumb'] if record else None
+
+    def quarantine(self, paths, reason):
+        """
+        Marks pictures which exceeded decoding limits; records get replaced (and the mark cleared) once files change
+        """
+        self.db.executemany("UPDATE files SET quarantine = ? WHERE path = ?", [(reason, path) for path in paths])
+        self.db.commit()
+        for path in paths:
+            if path in self.records:
+                self.records[path]['quarantine'] = reason
+
+    def quarantined(self, path):
+        """
+        :return: reason why the picture has been quarantined, or None
+        """
+        record = self.records.get(path)
+        return record.get('quarantine') if record else None
+
+    def palette(self, path, key):
+        """
+        :param key: palette key, as in tools.palette_key()
+        :return: list of (r, g, b) tuples, or None if not generated yet
+        """
+        record = self.records.get(path)
+        palettes = json.loads(record['palettes']) if record and record.get('palettes') else {}
+        return [tuple(color) for color in palettes[key]] if key in palettes else None
+
+    def store_palettes(self, path, palettes):
+        """
+        :param palettes: {palette key: list of (r, g, b) tuples}; records get replaced (and palettes cleared) once
+        files change
+        """
+        record = self.records.get(path)
+        if not record:
+            return
+        stored = json.loads(record['palettes']) if record.get('palettes') else {}
+        stored.update(palettes)
+        record['palettes'] = json.dumps(stored)
+        self.db.execute("UPDATE files SET palettes = ? WHERE path = ?", (record['palettes'], path))
+        self.db.commit()
+
+    def broken(self, path):
+        """
+        :return: True if we failed to decode the picture, and it has not changed since
+        """
+        record = self.records.get(path)
+        return record is not None and record['thumb'] is None
+
+    def placeholder(self, path):
+        record = self.records.get(path)
+        return record.get('placeholder') if record else None
+
+    def features(self, path):
+        """
+        :return: {feature: value} dictionary of what the single decode pass found, or None if not indexed
+        """
+        record = self.records.get(path)
+        return {feature: record.get(feature) for feature in FEATURES} if record else None
+
+    def thumb_data(self, thumb):
+        """
+        :param thumb: thumbnail file name
+        :return: ((width, height), {feature: value}) of another picture using the thumbnail, in any folder, e.g. before
+        renamed or moved; (None, None) if not found
+        """
+        row = self.db.execute("SELECT * FROM files WHERE thumb = ? AND width IS NOT NULL LIMIT 1", (thumb,)).fetchone()
+        if not row:
+            return None, None
+        return (row['width'], row['height']), {feature: row[feature] for feature in FEATURES}
+
+    def histogram(self, path):
+        record = self.records.get(path)
+        return record.get('histogram') if record else None
+
+    def dimensions(self, path):
+        record = self.records.get(path)
+        if record and record['width']:
+            return record['width'], record['height']
+        return None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpaper manager for Sway, i3 and some other WMs, as a frontend to swaybg and feh
+
+Packed thumbnail store: raw RGB thumbnails of a single source folder in one memory-mapped file, and the offset
+table in a json file next to it. Filling the preview takes no PNG decoding, nor opening a file per thumbnail.
+
+Author: Piotr Miller
+e-mail: nwg.piotr@gmail.com
+Website: http://nwg.pl
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import os
+import json
+import mmap
+
+from PIL import Image
+
+
+class ThumbnailPack(object):
+    def __init__(self, path, size):
+        """
+        :param path: pack file path w/o extension; '.pack' and '.json' files will be created
+        :param size: (width, height) of the box thumbnails fit in
+        """
+        self.pack_file = '{}.pack'.format(path)
+        self.table_file = '{}.json'.format(path)
+        self.size = size
+        # {thumbnail name: [offset, thumbnail file mtime_ns, width, height]}
+        self.table = {}
+        self.mm = None
+
+        try:
+            with open(self.table_file, 'r') as f:
+                content = json.load(f)
+            if tuple(content['size']) == tuple(size) and os.path.isfile(self.pack_file) and all(
+                    len(value) == 4 for value in content['thumbs'].values()):
+                self.table = content['thumbs']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        self.map()
+
+    def map(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+        if self.table and os.path.getsize(self.pack_file) > 0:
+            with open(self.pack_file, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def update(self, thumbs):
+        """
+        Appends new and changed thumbnails; rewrites the pack if more than a half of it is no longer in use.
+        :param thumbs: {thumbnail name: thumbnail file path} of all the pictures in the folder
+        :return: number of thumbnails (re)packed
+        """
+        stale = {}
+        for name, path in thumbs.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if name not in self.table or self.table[name][1] != mtime:
+                stale[name] = (path, mtime)
+
+        dead = len([name for name in self.table if name not in thumbs]) + len(
+            [name for name in stale if name in self.table])
+        if not self.table or dead > len(self.table) // 2:
+            # compact: repack all
+            self.table = {}
+            stale = {}
+            for name, path in thumbs.items():
+                try:
+                    stale[name] = (path, os.stat(path).st_mtime_ns)
+                except OSError:
+                    pass
+            mode = 'wb'
+        else:
+            self.table = {name: value for name, value in self.table.items() if name in thumbs}
+            mode = 'ab'
+        if not stale and mode == 'ab':
+            return 0
+
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+        # If interrupted, the table must not point to what was not written. A compacted pack replaces the old one
+        # (which may be mapped by another process) once written, and the old table is gone until then.
+        pack_file = self.pack_file
+        if mode == 'wb':
+            pack_file = '{}.tmp'.format(self.pack_file)
+            if os.path.isfile(self.table_file):
+                os.remove(self.table_file)
+        with open(pack_file, mode) as f:
+            offset = f.tell()
+            for name, (path, mtime) in stale.items():
+                try:
+                    with Image.open(path) as img:
+                        img = img.convert('RGB')
+                        if img.size[0] > self.size[0] or img.size[1] > self.size[1]:
+                            continue
+                        f.write(img.tobytes())
+                except Exception:
+                    continue
+                self.table[name] = [offset, mtime, img.size[0], img.size[1]]
+                offset += img.size[0] * img.size[1] * 3
+
+        if mode == 'wb':
+            os.replace(pack_file, self.pack_file)
+        with open('{}.tmp'.format(self.table_file), 'w') as f:
+            json.dump({'size': list(self.size), 'thumbs': self.table}, f)
+        os.replace('{}.tmp'.format(self.table_file), self.table_file)
+        self.map()
+        return len(stale)
+
+    def frame(self, name):
+        """
+        :param name: thumbnail name
+        :return: (raw RGB bytes, width, height) of the thumbnail, or None if not packed
+        """
+        if self.mm and name in self.table:
+            offset, mtime, width, height = self.table[name]
+            return self.mm[offset:offset + width * height * 3], width, height
+        return None
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
@@ -11,23 +11,59 @@ Project: https://github.com/nwg-piotr/azote
 License: GPL3
 """
 import os
-import glob
+import collections
 import hashlib
+import heapq
+import io
 import logging
-from PIL import Image
+import multiprocessing
+import multiprocessing.connection
+from PIL import Image, PngImagePlugin
+import archives
 import common
+import image_backend
+from thumb_index import ThumbnailIndex
+from thumb_pack import ThumbnailPack
 import pickle
 import subprocess
 import locale
 import pkg_resources
+import resource
 import shutil
+import struct
+import time
+import urllib.parse
+import warnings
 
 import json
 
-import gi
+from colorthief import ColorThief, MMCQ
 
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GdkPixbuf, GLib
+# Pre-warming the thumbnail cache runs w/o GTK
+if not common.headless:
+    import gi
+
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import GdkPixbuf, GLib
+
+
+# Palette sizes offered in the image menu
+PALETTE_COLORS = [6, 13, 19, 25]
+
+# How often to check for thumbnails created in the background
+THUMBNAILS_POLL_MS = 25
+
+# Colour grid stored in the thumbnail index for each picture
+PLACEHOLDER_SIZE = (8, 5)
+
+# Number of pictures to read ahead, while these before get decoded, if the folder is on a rotational disk
+READAHEAD_FILES = 4
+
+# Members of archives have no os.stat_result of their own; these values come from the archive file, but the size
+MemberStat = collections.namedtuple('MemberStat', ['st_size', 'st_mtime', 'st_mtime_ns', 'st_ino'])
+
+# Exceptions of pictures exceeding decoding limits set in azoterc
+DECODING_LIMITS = (MemoryError, Image.DecompressionBombError, Image.DecompressionBombWarning)
 
 
 def log(message, level=None):
@@ -248,70 +284,7 @@ def current_display():
 
 
 def set_env(language=None):
-    xdg_config_home = os.getenv('XDG_CONFIG_HOME')
-    common.config_home = xdg_config_home if xdg_config_home else os.path.join(os.getenv("HOME"), ".config")
-    common.azote_config_home = os.path.join(xdg_config_home, "azote") if xdg_config_home else os.path.join(
-        os.getenv("HOME"), ".config/azote")
-    if not os.path.isdir(common.azote_config_home):
-        os.mkdir(common.azote_config_home)
-
-    xdg_data_home = os.getenv('XDG_DATA_HOME')
-    common.data_home = xdg_data_home if xdg_data_home else os.path.join(os.getenv("HOME"), ".local/share/azote")
-    if not os.path.isdir(common.data_home):
-        os.mkdir(common.data_home)
-
-    # MIGRATE DATA to XDG Base_Directory Specification - compliant folders
-    # Up to v1.7.0 Azote used to store all the data here:
-    common.app_dir = os.path.join(os.getenv("HOME"), ".azote")
-
-    # Let's move all the content to their proper location, if not yet moved
-    data_migrated = False
-    migration_error = None
-    if os.path.isdir(common.app_dir):
-        try:
-            azote_rc = os.path.join(common.app_dir, 'azoterc')
-            if os.path.isfile(azote_rc):
-                shutil.move(azote_rc, os.path.join(common.azote_config_home, 'azoterc'))
-
-            azote_pkl = os.path.join(common.app_dir, 'settings.pkl')
-            if os.path.isfile(azote_pkl):
-                shutil.move(azote_pkl, os.path.join(common.data_home, 'settings.pkl'))
-
-            bcg_feh_dir = os.path.join(common.app_dir, 'backgrounds-feh')
-            if os.path.isdir(bcg_feh_dir):
-                cmd = 'cp -rf {} {}'.format(bcg_feh_dir, os.path.join(common.data_home, 'backgrounds-feh'))
-                os.system(cmd)
-
-            bcg_sway_dir = os.path.join(common.app_dir, 'backgrounds-sway')
-            if os.path.isdir(bcg_sway_dir):
-                cmd = 'cp -rf {} {}'.format(bcg_sway_dir, os.path.join(common.data_home, 'backgrounds-sway'))
-                os.system(cmd)
-
-            data_migrated = True
-        except Exception as e:
-            migration_error = e
-
-    if data_migrated:
-        # Remove the old ~/.azote folder
-        shutil.rmtree(common.app_dir)
-
-    # logging
-    common.log_file = os.path.join(common.data_home, "log.txt")
-    logging.basicConfig(filename=common.log_file, format='%(asctime)s %(levelname)s: %(message)s', filemode='w',
-                        level=logging.INFO)
-
-    try:
-        version = pkg_resources.require(common.app_name)[0].version
-    except Exception as e:
-        version = ' unknown version: {}'.format(e)
-
-    log('Azote v{}'.format(version), common.INFO)
-
-    if data_migrated:
-        log('Data migrated to XDG-compliant folders', common.INFO)
-
-    if migration_error:
-        log('Data migration error: {}'.format(migration_error), common.ERROR)
+    set_base_env()
 
     # We will preload the en_EN dictionary as default values
     common.lang = Language()
@@ -327,11 +300,6 @@ def set_env(language=None):
 
     common.displays = check_displays()
 
-    # thumbnails folder
-    common.thumb_dir = os.path.join(common.data_home, "thumbnails")
-    if not os.path.isdir(common.thumb_dir):
-        os.mkdir(common.thumb_dir)
-
     # command file
     common.cmd_file = os.path.join(os.getenv("HOME"), ".azotebg")
 
@@ -370,21 +338,19 @@ def set_env(language=None):
         common.sample_dir = '/usr/share/backgrounds/nwg-shell'
 
     common.settings = Settings()
-    if common.settings.clear_thumbnails:
-        clear_thumbnails(clear_all=True)
-        common.settings.clear_thumbnails = False
+    set_thumbnails_env()
 
-    # check programs capable of opening files of allowed extensions
+    # check programs capable of opening pictures of formats we know
     if os.path.isfile('/usr/share/applications/mimeinfo.cache'):
         common.associations = {}  # Will stay None if the mimeinfo.cache file not found
 
         with open(os.path.join('/usr/share/applications/mimeinfo.cache')) as f:
             mimeinfo_cache = f.read().splitlines()
 
-        for file_type in common.allowed_file_types:
+        for file_type, mime_type in image_backend.FORMATS.items():
             for line in mimeinfo_cache:
-                if line.startswith('image/{}'.format(file_type)):
-                    line = line.split('=')[1]  # cut out leading 'image/ext'
+                if line.startswith('{}='.format(mime_type)):
+                    line = line.split('=')[1]  # cut out leading 'image/type'
                     # Paths to .desktop files for opener names found
                     filenames = line[:-1].split(';')  # cut out trailing ';' to avoid empty last element after splitting
                     # prepend path
@@ -410,23 +376,6 @@ def set_env(language=None):
                             if name and exe:
                                 data.append((name, exe))
                     common.associations[file_type] = data
-                    """
-                    Not necessarily all programs register jpg and jpeg extension (e.g. gimp registers jpeg only).
-                    Let's create sets, join them and replace lists for both jpg and jpeg keys.
-                    """
-                    try:
-                        jpg = set(common.associations['jpg'])
-                        jpeg = set(common.associations['jpeg'])
-                        together = jpg | jpeg
-                        common.associations['jpg'] = together
-                        common.associations['jpeg'] = together
-                    except KeyError:
-                        pass
-                    # What if nothing found for 'jpg' or 'jpeg'?
-                    if 'jpg' not in common.associations and 'jpeg' in common.associations:
-                        common.associations['jpg'] = common.associations['jpeg']
-                    elif 'jpeg' not in common.associations and 'jpg' in common.associations:
-                        common.associations['jpeg'] = common.associations['jpg']
 
         log("Image associations: {}".format(common.associations), common.INFO)
     else:
@@ -509,6 +458,120 @@ def set_env(language=None):
         log('~/.Xresources file not found', common.INFO)
 
 
+def set_base_env(log_name="log.txt"):
+    """
+    Config and data folders, data migration and logging
+    """
+    xdg_config_home = os.getenv('XDG_CONFIG_HOME')
+    common.config_home = xdg_config_home if xdg_config_home else os.path.join(os.getenv("HOME"), ".config")
+    common.azote_config_home = os.path.join(xdg_config_home, "azote") if xdg_config_home else os.path.join(
+        os.getenv("HOME"), ".config/azote")
+    if not os.path.isdir(common.azote_config_home):
+        os.mkdir(common.azote_config_home)
+
+    xdg_data_home = os.getenv('XDG_DATA_HOME')
+    common.data_home = xdg_data_home if xdg_data_home else os.path.join(os.getenv("HOME"), ".local/share/azote")
+    if not os.path.isdir(common.data_home):
+        os.mkdir(common.data_home)
+
+    # MIGRATE DATA to XDG Base_Directory Specification - compliant folders
+    # Up to v1.7.0 Azote used to store all the data here:
+    common.app_dir = os.path.join(os.getenv("HOME"), ".azote")
+
+    # Let's move all the content to their proper location, if not yet moved
+    data_migrated = False
+    migration_error = None
+    if os.path.isdir(common.app_dir):
+        try:
+            azote_rc = os.path.join(common.app_dir, 'azoterc')
+            if os.path.isfile(azote_rc):
+                shutil.move(azote_rc, os.path.join(common.azote_config_home, 'azoterc'))
+
+            azote_pkl = os.path.join(common.app_dir, 'settings.pkl')
+            if os.path.isfile(azote_pkl):
+                shutil.move(azote_pkl, os.path.join(common.data_home, 'settings.pkl'))
+
+            bcg_feh_dir = os.path.join(common.app_dir, 'backgrounds-feh')
+            if os.path.isdir(bcg_feh_dir):
+                cmd = 'cp -rf {} {}'.format(bcg_feh_dir, os.path.join(common.data_home, 'backgrounds-feh'))
+                os.system(cmd)
+
+            bcg_sway_dir = os.path.join(common.app_dir, 'backgrounds-sway')
+            if os.path.isdir(bcg_sway_dir):
+                cmd = 'cp -rf {} {}'.format(bcg_sway_dir, os.path.join(common.data_home, 'backgrounds-sway'))
+                os.system(cmd)
+
+            data_migrated = True
+        except Exception as e:
+            migration_error = e
+
+    if data_migrated:
+        # Remove the old ~/.azote folder
+        shutil.rmtree(common.app_dir)
+
+    # logging
+    common.log_file = os.path.join(common.data_home, log_name)
+    logging.basicConfig(filename=common.log_file, format='%(asctime)s %(levelname)s: %(message)s', filemode='w',
+                        level=logging.INFO)
+
+    try:
+        version = pkg_resources.require(common.app_name)[0].version
+    except Exception as e:
+        version = ' unknown version: {}'.format(e)
+
+    log('Azote v{}'.format(version), common.INFO)
+
+    if data_migrated:
+        log('Data migrated to XDG-compliant folders', common.INFO)
+
+    if migration_error:
+        log('Data migration error: {}'.format(migration_error), common.ERROR)
+
+
+def set_headless_env():
+    """
+    Just what we need to create thumbnails w/o GTK
+    """
+    set_base_env(log_name="prewarm.log")
+    common.sample_dir = os.path.join(common.data_home, "sample")
+    common.settings = Settings()
+    set_thumbnails_env()
+
+
+def set_thumbnails_env():
+    # thumbnails folder
+    common.thumb_dir = os.path.join(common.data_home, "thumbnails")
+    if not os.path.isdir(common.thumb_dir):
+        os.mkdir(common.thumb_dir)
+    common.thumb_index = ThumbnailIndex(os.path.join(common.data_home, "thumbnails.db"))
+
+    # Decoding / resizing library
+    common.image_backend = image_backend.get_backend(common.settings.image_backend)
+    if not common.image_backend:
+        log('pyvips module not found, using Pillow as the image backend', common.WARNING)
+        common.image_backend = image_backend.get_backend('pillow')
+    common.env['image_backend'] = common.image_backend.name
+    log('Image backend: {}'.format(common.image_backend.name), common.INFO)
+
+    # freedesktop shared thumbnails folder
+    xdg_cache_home = os.getenv('XDG_CACHE_HOME')
+    common.shared_thumb_dir = os.path.join(xdg_cache_home if xdg_cache_home else os.path.join(
+        os.getenv("HOME"), ".cache"), "thumbnails")
+
+    if not common.headless:
+        # GdkPixbuf needs the webp-pixbuf-loader package to display WebP files
+        common.env['webp_pixbuf'] = 'webp' in [f.get_name() for f in GdkPixbuf.Pixbuf.get_formats()]
+        if common.settings.thumbnail_format == 'webp' and not common.env['webp_pixbuf']:
+            log('webp-pixbuf-loader not found, creating PNG thumbnails instead of WebP', common.WARNING)
+            common.settings.thumbnail_format = 'png'
+    if not common.thumb_index.count:
+        seed_thumbnail_totals()
+    if common.settings.clear_thumbnails:
+        # thumbnails will be recreated out of pyramid levels, if available
+        clear_thumbnails(clear_all=True, levels=False)
+        common.settings.clear_thumbnails = False
+
+
 def copy_backgrounds():
     used = []
     for item in common.display_boxes_list:
@@ -539,209 +602,1673 @@ def hash_name(full_path):
     return hashlib.md5(full_path.encode()).hexdigest()
 
 
-def create_thumbnails(scr_path):
-    # Let's count allowed files first
-    common.progress_bar.hide()
-    counter = 0
-    for extension in common.allowed_file_types:
-        for in_path in glob.glob(os.path.join(scr_path, "*.{}".format(extension))):
-            if file_allowed(in_path):
-                counter += 1
-    if counter > 0:
-        # get all the files of allowed types from current path
-        common.progress_bar.show()
-        common.progress_bar.set_fraction(0.0)
-        processed = 0
-        for extension in common.allowed_file_types:
-            for in_path in glob.glob(os.path.join(scr_path, "*.{}".format(extension))):
-                if file_allowed(in_path):
-                    thumb_name = "{}.png".format(hash_name(in_path))
-                    dest_path = os.path.join(common.thumb_dir, thumb_name)
-                    if not os.path.isfile(dest_path):
-                        create_thumbnail(in_path, dest_path, thumb_name)
-                    elif is_newer(in_path, dest_path):
-                        create_thumbnail(in_path, dest_path, thumb_name, True)
-                    processed += 1
-                    common.progress_bar.set_fraction(processed / counter)
-                    common.progress_bar.set_text(str(processed))
-                    while Gtk.events_pending():
-                        Gtk.main_iteration()
-    common.progress_bar.hide()
-
-
-def create_thumbnail(in_path, dest_path, thumb_name, refresh=False):
-    action = 'New thumb' if not refresh else 'Refresh'
-    try:
-        img = Image.open(in_path)
-        # convert to thumbnail image
-        img.thumbnail(common.settings.thumb_size, Image.ANTIALIAS)
+def hash_content(full_path, size, full=False):
+    """
+    Content fingerprint: MD5 of the file size, and of the first and last 64 kB of the file (or its whole content)
+    :param full_path: original file path
+    :param size: file size in bytes
+    :param full: hash the whole file content
+    :return: MD5 hex digest
+    """
+    block = 65536
+    md5 = hashlib.md5(str(size).encode())
+    with open(full_path, 'rb') as f:
+        if full or size <= 2 * block:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        else:
+            md5.update(f.read(block))
+            f.seek(-block, os.SEEK_END)
+            md5.update(f.read(block))
+    return md5.hexdigest()
 
-        img = expand_img(img)
 
-        img.save(dest_path, "PNG")
-        log('{}: {} -> {}'.format(action, in_path, thumb_name), common.INFO)
-    except Exception as e:
-        log('{} - {}'.format(action, e), common.ERROR)
+def thumbnail_key(full_path, stat_result=None):
+    """
+    Thumbnail name (w/o extension), depending on the 'thumbnail_keys' azoterc value:
+    'path' - MD5-hashed path; 'content' - fast content fingerprint; 'content-full' - MD5 of the whole file.
+    Content-based keys survive renaming and moving files, and identical files share the same thumbnail.
+    :param full_path: original file path
+    :param stat_result: os.stat_result of the file, if already known
+    """
+    if common.settings.thumbnail_keys == 'path' or archive_member(full_path):
+        # members of archives would need decompressing to fingerprint
+        return hash_name(full_path)
+    size = stat_result.st_size if stat_result else os.path.getsize(full_path)
+    return hash_content(full_path, size, full=common.settings.thumbnail_keys == 'content-full')
 
 
-def flip_selected_wallpaper():
+def thumbnail_extension():
+    return {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}[common.settings.thumbnail_format]
+
+
+def save_thumbnail(img, path, thumbnail_format=None):
     """
-    This creates vertically flipped image and its thumbnail and saves to ~/.azote/backgrounds
-    :return: thumbnail path, flipped image path
+    Saves the thumbnail in the format set in azoterc
+    :param img: PIL.Image
+    :param path: destination path
+    :param thumbnail_format: 'png', 'jpeg' or 'webp' to override the azoterc value
     """
-    if common.selected_wallpaper:
-        try:
-            img = Image.open(common.selected_wallpaper.source_path)
-            flipped = img.transpose(Image.FLIP_LEFT_RIGHT)
-            img_path = os.path.join(common.bcg_dir, "flipped-{}".format(common.selected_wallpaper.filename))
-            flipped.save(os.path.join(common.tmp_dir, "flipped-{}".format(common.selected_wallpaper.filename)), "PNG")
+    thumbnail_format = thumbnail_format if thumbnail_format else common.settings.thumbnail_format
+    if thumbnail_format == 'jpeg':
+        img.convert('RGB').save(path, "JPEG", quality=common.settings.thumbnail_quality)
+    elif thumbnail_format == 'webp':
+        img.save(path, "WEBP", quality=common.settings.thumbnail_quality)
+    else:
+        img.save(path, "PNG", compress_level=common.settings.thumbnail_compress_level)
+
 
-            flipped.thumbnail(common.settings.thumb_size, Image.ANTIALIAS)
-            flipped = expand_img(flipped)
+def thumbnail_path(source_path, placeholder=False):
+    """
+    :param source_path: original file path
+    :param placeholder: if not indexed yet, name the thumbnail after the path, not to read the file while building
+    the preview; the background scan assigns content keys
+    :return: path to the thumbnail file
+    """
+    thumb_name = common.thumb_index.thumb_name(source_path)
+    if not thumb_name:
+        key = hash_name(source_path) if placeholder else thumbnail_key(source_path)
+        thumb_name = "{}{}".format(key, thumbnail_extension())
+    return os.path.join(common.thumb_dir, thumb_name)
 
-            thumb_path = os.path.join(common.tmp_dir, "thumbnail-{}".format(common.selected_wallpaper.filename))
-            flipped.save(thumb_path, "PNG")
-            return thumb_path, img_path
 
+def image_dimensions(source_path):
+    """
+    :param source_path: original file path
+    :return: (width, height) tuple, read from the thumbnail index if possible; None if the file can't be read
+    """
+    dimensions = common.thumb_index.dimensions(source_path)
+    if not dimensions:
+        try:
+            with Image.open(picture_source(source_path)) as img:
+                dimensions = img.size
         except Exception as e:
-            log('Failed flipping {} - {}'.format(common.selected_wallpaper.source_path, e), common.ERROR)
+            log('Failed reading {} - {}'.format(source_path, e), common.ERROR)
+    return dimensions
 
 
-def split_selected_wallpaper(num_parts):
-    try:
-        img = Image.open(common.selected_wallpaper.source_path)
-        width, height = img.size
-        is_horizontal = width >= height
-        if is_horizontal:
-            part_width = width // num_parts
-            part_height = height
-        else:
-            part_width = width
-            part_height = height // num_parts
-        paths_list = []
-        for i in range(num_parts):
-            if is_horizontal:
-                box = (i * part_width, 0, i * part_width + part_width, part_height)
-            else:
-                box = (0, i * part_height, part_width, i * part_height + part_height)
-            part = img.crop(box)
-            img_path = os.path.join(common.bcg_dir, "part{}-{}".format(i, common.selected_wallpaper.filename))
-            part.save(os.path.join(common.tmp_dir, "part{}-{}".format(i, common.selected_wallpaper.filename)), "PNG")
+def create_thumbnails(scr_path, on_created=None, folder_scan=None):
+    """
+    Creates missing and refreshes outdated thumbnails of pictures in the folder, and waits until done
+    :param scr_path: source folder path
+    :param on_created: function to call with (source path, thumbnail name) as soon as a thumbnail is ready
+    :param folder_scan: FolderScan of the folder, if already made
+    """
+    for _ in scan_thumbnails(scr_path, on_created, folder_scan=folder_scan):
+        pass
 
-            part.thumbnail(common.settings.thumb_size, Image.ANTIALIAS)
 
-            thumb_path = os.path.join(common.tmp_dir, "thumb-part{}-{}".format(i, common.selected_wallpaper.filename))
+def start_thumbnails(scr_path, on_created=None, on_finished=None, priority=None, folder_scan=None):
+    """
+    Creates thumbnails in the background, polling sandbox processes from the GTK main loop. The scan in progress,
+    if any, gets cancelled: we never run two at a time.
+    :param on_created: function to call with (source path, thumbnail name) as soon as a thumbnail is ready
+    :param on_finished: function to call when all thumbnails of the folder are ready
+    :param priority: function returning a (bucket, position) priority tuple of the source path, see scan_thumbnails
+    :param folder_scan: FolderScan of the folder, if already made
+    """
+    cancel_thumbnails()
+    scan = scan_thumbnails(scr_path, on_created, block=False, priority=priority, folder_scan=folder_scan)
+    common.thumbnail_scan = scan, scr_path, GLib.timeout_add(THUMBNAILS_POLL_MS, thumbnails_step, on_finished)
 
-            part = expand_img(part)
 
-            part.save(thumb_path, "PNG")
-            paths = (img_path, thumb_path)
-            paths_list.append(paths)
-        return paths_list
+def cancel_thumbnails():
+    """
+    Stops creating thumbnails in the background; thumbnails ready so far get indexed, the rest is left for later
+    """
+    if common.thumbnail_scan:
+        scan, scr_path, source_id = common.thumbnail_scan
+        common.thumbnail_scan = None
+        GLib.source_remove(source_id)
+        scan.close()
+        log('Thumbnails of {} cancelled'.format(scr_path), common.INFO)
+        hide_progress_bar()
 
-    except Exception as e:
-        log('Failed splitting {} - {}'.format(common.selected_wallpaper.source_path, e), common.ERROR)
-
-
-def expand_img(image):
-    # We want the thumbnail to be always in the same proportion. Let's expand if necessary.
-    width, height = image.size
-    border_h = (common.settings.thumb_width - width) // 2
-    border_v = (common.settings.thumb_height - height) // 2
-    if border_v > 0 or border_h > 0:
-        # border = (border_h, border_v, border_h, border_v)
-        # return ImageOps.expand(image, border=border)
-        # Let's add checkered background instead of the black one
-        background = Image.open('images/squares.jpg')
-        background = background.resize(common.settings.thumb_size, Image.ANTIALIAS)
-        background.paste(image, (border_h, border_v))
-        return background
-    else:
-        return image
+
+def reprioritize_thumbnails(paths=None):
+    """
+    Reorders thumbnails waiting to be created in the background, e.g. after the preview has been scrolled
+    :param paths: source paths which priority may have changed; all if None
+    """
+    if common.thumbnail_queue:
+        common.thumbnail_queue.reprioritize(paths)
 
 
-def scale_and_crop(item, image_path, width, height):
-    img = Image.open(image_path)
+def thumbnails_step(on_finished):
+    scan, scr_path, source_id = common.thumbnail_scan
+    if scr_path != common.settings.src_path:
+        # stale: another folder has been opened
+        cancel_thumbnails()
+        return False
+    try:
+        # handle all the results ready, until the scan needs to wait for sandbox processes
+        while next(scan):
+            pass
+        return True
+    except StopIteration:
+        common.thumbnail_scan = None
+        if on_finished:
+            on_finished()
+        return False
 
-    # We can either scale vertically & crop horizontally or scale horizontally and crop vertically
-    new_height = int(img.size[0] * height / width)
 
-    if new_height < img.size[1]:  # we need to scale to display width and crop vertical margins
-        new_height = int(width * img.size[1] / img.size[0])
-        # Choose the filter depending on if we're scaling down or up
-        if new_height >= height:
-            img = img.resize((width, new_height), Image.ANTIALIAS)
+class FolderScan(object):
+    """
+    Pictures of the folder, and of its subfolders if 'recursive_scan' (azoterc) is on. In the recursive mode only
+    directories which mtime changed since the last stored scan get listed again; pictures of the rest come from the
+    thumbnail index, w/o a single stat call. Members of archives found come in as virtual paths, see archive_pictures.
+    One scan per refresh: the preview grid, sorting, creating thumbnails and tracking changes all share it.
+    """
+    def __init__(self, folder):
+        """
+        :param folder: source folder path; FileNotFoundError raised if gone
+        """
+        self.folder = folder
+        self.recursive = common.settings.recursive_scan
+        # [(path, os.stat_result / MemberStat, or None if the directory has not changed since the last scan)]
+        self.pictures = []
+        # {directory path: st_mtime_ns} of all directories walked
+        self.dir_mtimes = {}
+        # [(directory path, st_mtime_ns, subdirectory names, picture names)] of directories listed again
+        self.listed = []
+        self.gone = []
+        if self.recursive:
+            self.scan_tree()
         else:
-            img = img.resize((width, new_height), Image.BILINEAR)
+            self.dir_mtimes[folder] = os.stat(folder).st_mtime_ns
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file() and self.archive(entry.name):
+                        self.pictures += archive_pictures(entry.path, entry.stat())
+                    elif entry.is_file() and file_allowed(entry.path, entry.stat()):
+                        self.pictures.append((entry.path, entry.stat()))
+
+    @staticmethod
+    def archive(name):
+        return common.settings.browse_archives and archives.is_archive(name)
+
+    def scan_tree(self):
+        indexed = common.thumb_index.load_dirs(self.folder)
+        pending = [self.folder]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                if path == self.folder:
+                    raise
+                continue
+            self.dir_mtimes[path] = mtime
+            record = indexed.get(path)
+            if record and record['mtime'] == mtime:
+                for name in record['files']:
+                    if self.archive(name):
+                        # archives may have been overwritten in place
+                        self.pictures += archive_pictures(os.path.join(path, name))
+                    elif not archives.is_archive(name):
+                        self.pictures.append((os.path.join(path, name), None))
+                pending += [os.path.join(path, name) for name in record['subdirs']]
+                continue
+
+            subdirs, files = [], []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        # hidden folders skipped; symlinks not followed, not to loop
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith('.'):
+                                subdirs.append(entry.name)
+                        elif entry.is_file() and archives.is_archive(entry.name):
+                            # listed whether browsed or not, for the listing not to depend on azoterc
+                            files.append(entry.name)
+                            if self.archive(entry.name):
+                                self.pictures += archive_pictures(entry.path, entry.stat())
+                        elif entry.is_file() and file_allowed(entry.path, entry.stat()):
+                            files.append(entry.name)
+                            self.pictures.append((entry.path, entry.stat()))
+            except OSError as e:
+                if path == self.folder:
+                    raise
+                log('Failed scanning {} - {}'.format(path, e), common.WARNING)
+                continue
+            self.listed.append((path, mtime, subdirs, files))
+            pending += [os.path.join(path, name) for name in subdirs]
+        self.gone = [path for path in indexed if path not in self.dir_mtimes]
+
+    def store(self):
+        """
+        Saves directories listed again to the thumbnail index; to be called once their pictures have been indexed
+        """
+        if self.recursive and (self.listed or self.gone):
+            common.thumb_index.store_dirs(self.folder, self.listed, self.gone)
+            log('{}: {} of {} directories rescanned'.format(self.folder, len(self.listed), len(self.dir_mtimes)),
+                common.INFO)
+
+    def mtime(self, path, stat_result):
+        """
+        :return: file modification time, from the thumbnail index if not stat-ed
+        """
+        if stat_result:
+            return stat_result.st_mtime
+        record = common.thumb_index.records.get(path)
+        if record and record['mtime'] is not None:
+            return record['mtime'] / 1e9
+        return os.path.getmtime(path)
+
+    def changed(self):
+        """
+        :return: True if any directory walked has changed since, e.g. pictures added or removed; a single stat call
+        if not recursive
+        """
+        for path, mtime in self.dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
 
-        margin = (img.size[1] - height) // 2
-        img = img.crop((0, margin, width, height + margin))
 
-    elif new_height > img.size[1]:  # we need to scale to display height and crop horizontal margins
-        new_width = int(img.size[0] * height / img.size[1])
-        if new_width >= width:
-            img = img.resize((new_width, height), Image.ANTIALIAS)
-        else:
-            img = img.resize((new_width, height), Image.BILINEAR)
+def archive_pictures(path, stat_result=None):
+    """
+    Pictures in the archive, listed once and then read from the thumbnail index until the archive changes. Records of
+    members get kept in common.archives, for sandbox processes to inherit them.
+    :param path: archive path
+    :param stat_result: os.stat_result of the archive, if already known
+    :return: list of (virtual path, MemberStat) tuples
+    """
+    try:
+        st = stat_result if stat_result else os.stat(path)
+        listed = common.thumb_index.archive(path, st)
+        if listed is None:
+            kind, members = archives.list_members(path, image_backend.HEADER_BYTES)
+            # only pictures indexed; format name appended to the member record
+            listed = kind, [record + [image_backend.probe(header)] for record, header in members
+                            if image_backend.probe(header)]
+            common.thumb_index.store_archive(path, st, *listed)
+            log('Archive {}: {} pictures of {} members'.format(path, len(listed[1]), len(members)), common.INFO)
+    except archives.ERRORS as e:
+        log('Failed reading {} - {}'.format(path, e), common.WARNING)
+        return []
+    kind, records = listed
+    common.archives[path] = (st.st_mtime_ns, kind, {record[0]: record for record in records})
+    pictures = []
+    for record in records:
+        if format_decodable(record[5]):
+            member_path = os.path.join(path, record[0])
+            member_st = MemberStat(record[3], st.st_mtime, st.st_mtime_ns, st.st_ino)
+            common.picture_formats[member_path] = (member_st.st_mtime_ns, member_st.st_size, record[5])
+            pictures.append((member_path, member_st))
+    return pictures
+
+
+def archive_member(path):
+    """
+    :param path: picture path, possibly virtual: archive path/member name
+    :return: (archive path, kind, member record) tuple, or None if not a member of an archive browsed
+    """
+    if not common.archives:
+        return None
+    split = archives.split_path(path, lambda archive_path: archive_path in common.archives)
+    if not split:
+        return None
+    mtime_ns, kind, members = common.archives[split[0]]
+    record = members.get(split[1])
+    return (split[0], kind, record) if record else None
 
-        margin = (img.size[0] - width) // 2
-        img = img.crop((margin, 0, width + margin, height))
 
-    else:
-        img = img.resize((width, height), Image.ANTIALIAS)
+def picture_stat(path):
+    """
+    :return: os.stat_result of the picture, or MemberStat if a member of an archive
+    """
+    member = archive_member(path)
+    if member:
+        st = os.stat(member[0])
+        return MemberStat(member[2][3], st.st_mtime, st.st_mtime_ns, st.st_ino)
+    return os.stat(path)
 
-    img.save('{}-{}x{}{}'.format(os.path.splitext(image_path)[0], width, height, os.path.splitext(image_path)[1]))
-    common.preview.refresh()
 
+def picture_source(path):
+    """
+    :return: what to pass to Image.open: the path, or the file-like content of the archive member
+    """
+    if path in common.extracted:
+        return common.extracted[path]
+    member = archive_member(path)
+    return io.BytesIO(archives.read_member(*member)) if member else path
 
-def is_newer(in_path, dest_path):
-    return os.path.getmtime(in_path) > os.path.getmtime(dest_path)
 
+def picture_backend(path):
+    # libvips reads files by path; members of archives go to Pillow
+    return common.image_backend if not archive_member(path) else image_backend.PillowBackend()
 
-def file_allowed(path):
-    ext = path.split('.')[-1].lower()
-    return ext in common.allowed_file_types
 
+def extract_wallpaper(path):
+    """
+    swaybg, feh and picture viewers need real files: the archive member gets extracted to the backgrounds folder,
+    which only keeps files in use (see copy_backgrounds)
+    :param path: virtual path of the archive member
+    :return: path of the file extracted, or None if failed
+    """
+    archive_path, kind, record = archive_member(path)
+    dest_path = os.path.join(common.bcg_dir, 'archived-{}-{}'.format(
+        hash_name('{}:{}'.format(path, common.archives[archive_path][0]))[:8], os.path.basename(path)))
+    if not os.path.isfile(dest_path):
+        try:
+            archives.extract_member(archive_path, kind, record, dest_path)
+            log('Extracted: {} -> {}'.format(path, dest_path), common.INFO)
+        except archives.ERRORS as e:
+            log('Failed extracting {} - {}'.format(path, e), common.ERROR)
+            return None
+    return dest_path
 
-def update_status_bar():
-    num_files = 0
-    total_size = 0
-    if os.path.isdir(common.thumb_dir):
-        for file in os.listdir(common.thumb_dir):
-            num_files += 1
-            file_info = os.stat(os.path.join(common.thumb_dir, file))
-            total_size += file_info.st_size
-    common.status_bar.push(0, common.lang['thumbnails_in_cache'].format(num_files, convert_bytes(total_size)))
-
-
-def clear_thumbnails(clear_all=False):
-    files_in_use = os.listdir(common.settings.src_path)
-    for i in range(len(files_in_use)):
-        full_path = os.path.join(common.settings.src_path, files_in_use[i])
-        files_in_use[i] = '{}.png'.format(hashlib.md5(full_path.encode()).hexdigest())
 
-    number = 0
-    for file in os.listdir(common.thumb_dir):
-        if file not in files_in_use or clear_all:
-            file_path = os.path.join(common.thumb_dir, file)
-            try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    number += 1
-            except Exception as e:
-                print(e)
-    msg = 'thumbnails' if clear_all else 'unused thumbnails'
-    print('\nAzote: {} {} deleted\n'.format(number, msg))
+def extract_streams(jobs, block=True):
+    """
+    Extracts members of compressed tar files waiting for thumbnails, in a single pass per archive, to a temporary
+    folder; see picture_source. Runs in sandbox processes, as archives may be big, or broken.
+    :param jobs: thumbnail jobs
+    :param block: see sandbox_jobs
+    :return: generator yielding False while waiting for sandbox processes
+    """
+    streams = collections.defaultdict(list)  # {archive path: [member name]}
+    for job in jobs:
+        member = archive_member(job[0])
+        if member and member[1] == 'tar-stream':
+            streams[member[0]].append(member[2][0])
+    if not streams:
+        return
+    os.makedirs(streams_dir(), exist_ok=True)
+    workers = common.settings.thumbnail_workers if common.settings.thumbnail_workers > 0 else os.cpu_count()
+    for job, extracted in sandbox_jobs(extract_stream_job, [(path, names, streams_dir()) for path, names in
+                                                            streams.items()], workers, block=block, timeout=0):
+        if not job:
+            yield False
+        elif isinstance(extracted, dict):
+            common.extracted.update({os.path.join(job[0], name): path for name, path in extracted.items()})
+        else:
+            # members get read from the archive, one by one
+            log('Failed extracting members of {}'.format(job[0]), common.WARNING)
 
 
-def convert_bytes(num):
+def extract_stream_job(job):
     """
-    https://stackoverflow.com/a/39988702/4040598
+    Runs in a sandbox process
+    :param job: (archive path, [member name], destination folder) tuple
+    :return: {member name: path of the file extracted}
     """
-    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
-        if num < 1024.0:
-            return "%3.1f %s" % (num, x)
-        num /= 1024.0
+    return archives.extract_members(*job)
+
+
+def streams_dir():
+    return os.path.join(common.thumb_dir, 'streams')
+
+
+def forget_streams():
+    """
+    Deletes members of compressed tar files extracted by extract_streams
+    """
+    common.extracted = {}
+    if os.path.isdir(streams_dir()):
+        shutil.rmtree(streams_dir(), ignore_errors=True)
+
+
+def scan_thumbnails(scr_path, on_created=None, block=True, priority=None, folder_scan=None):
+    """
+    :param block: if False, the generator yields False instead of waiting for sandbox processes, and every
+    THUMBNAILS_POLL_MS while checking pictures, not to keep the GUI busy
+    :param priority: function returning a (bucket, position) priority tuple of the source path, the lowest going
+    first; jobs in order found if None. On rotational disks jobs out of the first bucket go in inode order instead.
+    :param folder_scan: FolderScan of the folder, if already made; the folder gets scanned if None
+    :return: generator yielding True after each job done
+    """
+    # Let's collect files which need a new or refreshed thumbnail first
+    hide_progress_bar()
+    indexed = common.thumb_index.load(scr_path)
+    found, jobs, conversions, stats, entries, quarantined, converted = set(), [], [], {}, [], [], []
+    formats = {}  # {path: format name} of pictures indexed w/o it
+    adopted_features = {}  # {path: {feature: value}} of pictures which thumbnails get converted, if not indexed
+    sharing = {}  # {dest_path: [paths of other files of the same content]}
+    extension = thumbnail_extension()
+    scan = folder_scan if folder_scan else FolderScan(scr_path)
+    # keys of unindexed pictures may take reading them: let the main loop run in between
+    deadline = time.monotonic() + THUMBNAILS_POLL_MS / 1000
+    for in_path, st in scan.pictures:
+        if not block and time.monotonic() > deadline:
+            yield False
+            deadline = time.monotonic() + THUMBNAILS_POLL_MS / 1000
+        found.add(in_path)
+        if st is None and in_path in indexed and indexed[in_path]['mtime'] is not None:
+            # its directory has not changed since the last scan
+            current = True
+        else:
+            st = st if st else os.stat(in_path)
+            current = common.thumb_index.is_current(in_path, st)
+        if current:
+            if indexed[in_path].get('format') is None:
+                # indexed before formats were
+                formats[in_path] = picture_format(in_path, st)
+            # thumbnail of another format than set in azoterc; no thumbnail if the picture failed to decode
+            old_name = common.thumb_index.thumb_name(in_path)
+            if old_name and not old_name.endswith(extension):
+                stats[in_path] = st if st else os.stat(in_path)
+                conversions.append((in_path, old_name, "{}{}".format(os.path.splitext(old_name)[0], extension),
+                                    common.thumb_index.dimensions(in_path)))
+            continue
+        key = thumbnail_key(in_path, st)
+        thumb_name = "{}{}".format(key, extension)
+        dest_path = os.path.join(common.thumb_dir, thumb_name)
+        if dest_path in sharing:
+            # identical content, and the thumbnail is already being created
+            sharing[dest_path].append(in_path)
+            stats[in_path] = st
+            continue
+        if in_path not in indexed:
+            # thumbnail created before the index existed, or the file has been renamed / moved / copied
+            adopted = False
+            for name in [thumb_name, "{}.png".format(key)]:
+                path = os.path.join(common.thumb_dir, name)
+                if os.path.isfile(path) and (common.settings.thumbnail_keys != 'path' or
+                                             not is_newer(in_path, path)):
+                    # dimensions and features of the picture as indexed under another path, if any
+                    dimensions, features = common.thumb_index.thumb_data(name)
+                    if name == thumb_name:
+                        entries.append((in_path, st, thumb_name, dimensions, features))
+                        # the placeholder may be named after the path
+                        if on_created:
+                            on_created(in_path, thumb_name)
+                    else:
+                        stats[in_path] = st
+                        conversions.append((in_path, name, thumb_name, dimensions))
+                        adopted_features[in_path] = features
+                    adopted = True
+                    break
+            if adopted:
+                continue
+        stats[in_path] = st
+        sharing[dest_path] = []
+        record = indexed.get(in_path)
+        # records invalidated (e.g. 'thumb_width' changed) have no mtime; the picture itself may have not changed
+        changed = record is not None and (record['size'] != st.st_size or record['inode'] != st.st_ino or
+                                          record['mtime'] not in (None, st.st_mtime_ns))
+        jobs.append((in_path, dest_path, thumb_name, in_path in indexed, changed))
+    hdd = common.settings.hdd_mode == 'on' or (common.settings.hdd_mode == 'auto' and rotational_disk(scr_path))
+    if hdd:
+        # Inode numbers roughly follow the on-disk layout; jobs of equal priority go in this order
+        jobs.sort(key=lambda job: stats[job[0]].st_ino)
+
+    def key(job):
+        bucket, position = priority(job[0])
+        # but for the visible part of the preview
+        return (bucket, stats[job[0]].st_ino) if hdd and bucket else (bucket, position)
+    try:
+        if jobs or conversions:
+            update_progress_bar(0, len(jobs) + len(conversions))
+            common.thumbnail_queue = JobQueue(conversions, key if priority else None)
+            for job, result in run_jobs(convert_thumbnail_job, common.thumbnail_queue, len(jobs) + len(conversions),
+                                        block=block):
+                if not job:
+                    yield False
+                    continue
+                converted.append(job[1])
+                if not isinstance(result, Quarantine) and result[2]:
+                    entries.append((result[0], stats[result[0]], result[1], result[3],
+                                    adopted_features.get(result[0], common.thumb_index.features(result[0]))))
+                    if on_created:
+                        on_created(result[0], result[1])
+                yield True
+            yield from extract_streams(jobs, block)
+            common.thumbnail_queue = JobQueue(jobs, key if priority else None, READAHEAD_FILES if hdd else 0)
+            for job, result in run_jobs(thumbnail_job, common.thumbnail_queue, len(jobs) + len(conversions),
+                                        len(conversions), block=block):
+                if not job:
+                    yield False
+                    continue
+                if isinstance(result, Quarantine):
+                    log('Quarantined: {} - {}'.format(job[0], result.reason), common.ERROR)
+                    quarantined.append(([job[0]] + sharing[job[1]], result.reason))
+                    result = job[0], job[2], None, None
+                created = job_entries(result, stats, sharing)
+                if on_created:
+                    for entry in created:
+                        on_created(entry[0], entry[2])
+                entries += created
+                yield True
+    finally:
+        common.thumbnail_queue = None
+        forget_streams()
+        # also if cancelled: thumbnails created so far must not be lost
+        if entries:
+            common.thumb_index.store(scr_path, entries, {entry[0]: picture_format(entry[0], entry[1])
+                                                         for entry in entries})
+            for paths, reason in quarantined:
+                common.thumb_index.quarantine(paths, reason)
+            common.thumb_index.add_thumbnails({entry[2]: thumbnail_bytes(entry[2]) for entry in entries if entry[2]},
+                                              time.time())
+        if converted:
+            # thumbnails of the previous format have been deleted
+            common.thumb_index.forget_thumbnails(converted)
+    if formats:
+        common.thumb_index.store_formats(formats)
+    removed = [path for path in indexed if path not in found]
+    if removed:
+        common.thumb_index.forget(removed)
+    # not if cancelled: pictures of directories listed must get indexed first
+    scan.store()
+    common.thumb_index.touch(scr_path, time.time())
+    evict_thumbnails(scr_path)
+    if common.settings.packed_thumbnails:
+        yield from update_thumbnail_pack(scr_path, block)
+    hide_progress_bar()
+
+
+def picture_palette(image_path, num_colors):
+    """
+    :param image_path: source file path
+    :param num_colors: number of colours
+    :return: list of (r, g, b) tuples, from the thumbnail index if already generated; None if failed
+    """
+    palette = common.thumb_index.palette(image_path, palette_key(num_colors))
+    if palette:
+        return palette
+    reason = common.thumb_index.quarantined(image_path)
+    if not reason:
+        palettes = run_sandboxed(palette_job, (image_path, [num_colors], common.thumb_index.histogram(image_path)))
+        if isinstance(palettes, Quarantine):
+            reason = palettes.reason
+            common.thumb_index.quarantine([image_path], reason)
+        elif palettes:
+            common.thumb_index.store_palettes(image_path, palettes)
+            palette = palettes[palette_key(num_colors)]
+    if reason:
+        log('Quarantined: {} - {}'.format(image_path, reason), common.ERROR)
+    return palette
+
+
+def prewarm_palettes(folder):
+    """
+    Generates palettes of all the sizes offered in the image menu, for indexed pictures of the folder; stored as soon
+    as generated, not to be lost if interrupted
+    :param folder: source folder path, which thumbnails have just been created
+    :return: number of pictures processed
+    """
+    jobs = []
+    for path, record in common.thumb_index.load(folder).items():
+        if record['thumb'] and not record.get('quarantine'):
+            numbers = [n for n in PALETTE_COLORS if not common.thumb_index.palette(path, palette_key(n))]
+            if numbers:
+                jobs.append((path, numbers, record.get('histogram')))
+    workers = common.settings.thumbnail_workers if common.settings.thumbnail_workers > 0 else os.cpu_count()
+    for job, palettes in sandbox_jobs(palette_job, jobs, workers):
+        if isinstance(palettes, Quarantine):
+            log('Quarantined: {} - {}'.format(job[0], palettes.reason), common.ERROR)
+            common.thumb_index.quarantine([job[0]], palettes.reason)
+        elif palettes:
+            common.thumb_index.store_palettes(job[0], palettes)
+    return len(jobs)
+
+
+def palette_key(num_colors):
+    # palettes depend on the 'palette_quality' azoterc value, too
+    return '{}/{}'.format(num_colors, common.settings.palette_quality)
+
+
+def palette_job(job):
+    """
+    Runs in a sandbox process; palettes come from the colour histogram found while creating the thumbnail, if any.
+    Otherwise the picture is decoded once for all the palettes.
+    :param job: (image_path, list of numbers of colours, packed histogram or None) tuple
+    :return: {palette key: list of (r, g, b) tuples}
+    """
+    image_path, numbers, histogram = job
+    if histogram:
+        histogram = {index: count for index, count in struct.iter_unpack('<HI', histogram)}
+        return {palette_key(num_colors): MMCQ.quantize_histo(histogram, num_colors).palette for num_colors in numbers}
+    color_thief = ColorThief(picture_source(image_path))
+    return {palette_key(num_colors): color_thief.get_palette(color_count=num_colors,
+                                                             quality=common.settings.palette_quality)
+            for num_colors in numbers}
+
+
+def run_jobs(function, jobs, total, done=0, block=True):
+    """
+    Runs jobs in sandbox processes, updating the progress bar
+    :param function: function to call with each job
+    :param jobs: list of job arguments, or JobQueue
+    :param total: total number of jobs, for the progress bar
+    :param done: number of jobs already done, for the progress bar
+    :param block: see sandbox_jobs
+    :return: generator yielding (job, result) tuples, in order of completion
+    """
+    workers = common.settings.thumbnail_workers if common.settings.thumbnail_workers > 0 else os.cpu_count()
+    processed = done
+    for job, result in sandbox_jobs(function, jobs, workers, block):
+        if job:
+            processed += 1
+            update_progress_bar(processed, total)
+        yield job, result
+
+
+class JobQueue(object):
+    """
+    Jobs waiting for a sandbox process, the lowest priority first; the order may change while jobs are running
+    """
+    def __init__(self, jobs, priority=None, readahead=0):
+        """
+        :param jobs: list of job arguments
+        :param priority: function returning a comparable priority of the job; jobs go in order given if None
+        :param readahead: number of next jobs which source files (job[0]) to read ahead on each pop
+        """
+        self.priority = priority
+        # [priority, number, job] entries; these re-keyed get replaced, and the old ones left with no job
+        self.heap = [[priority(job) if priority else 0, number, job] for number, job in enumerate(jobs)]
+        heapq.heapify(self.heap)
+        self.entries = {entry[1]: entry for entry in self.heap}
+        self.numbers = {job[0]: number for number, job in enumerate(jobs)}
+        self.readahead = readahead
+        self.read_ahead = set()
+
+    def reprioritize(self, keys=None):
+        """
+        :param keys: job[0] values of jobs which priority may have changed; all jobs if None
+        """
+        if not self.priority:
+            return
+        if keys is None:
+            self.heap = [[self.priority(entry[2]), entry[1], entry[2]] for entry in self.entries.values()]
+            heapq.heapify(self.heap)
+            self.entries = {entry[1]: entry for entry in self.heap}
+            return
+        for key in keys:
+            entry = self.entries.get(self.numbers.get(key))
+            if entry:
+                priority = self.priority(entry[2])
+                if priority != entry[0]:
+                    self.entries[entry[1]] = [priority, entry[1], entry[2]]
+                    heapq.heappush(self.heap, self.entries[entry[1]])
+                    entry[2] = None
+
+    def pop(self):
+        entry = heapq.heappop(self.heap)
+        while entry[2] is None:
+            entry = heapq.heappop(self.heap)
+        del self.entries[entry[1]]
+        if self.readahead:
+            # the next jobs are among the top of the heap
+            for key, number, next_job in heapq.nsmallest(self.readahead, [
+                    entry for entry in self.heap[:2 ** (self.readahead + 1)] if entry[2]]):
+                if next_job[0] not in self.read_ahead:
+                    self.read_ahead.add(next_job[0])
+                    read_ahead(next_job[0])
+        return entry[2]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def read_ahead(path):
+    """
+    Lets the kernel start reading the file into the page cache, for the decoder not to wait for the disk later
+    """
+    # just the member of an archive, if seekable
+    member = archive_member(path)
+    if member and member[2][1] is None:
+        return
+    path, offset, length = (member[0], member[2][1], member[2][2]) if member else (path, 0, 0)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except (AttributeError, OSError) as e:
+        log('Failed reading ahead {} - {}'.format(path, e), common.WARNING)
+
+
+def rotational_disk(path):
+    """
+    :param path: file or folder path
+    :return: True if the block device it's stored on is a rotational one (HDD), according to sysfs
+    """
+    try:
+        st_dev = os.stat(path).st_dev
+        device = os.path.realpath('/sys/dev/block/{}:{}'.format(os.major(st_dev), os.minor(st_dev)))
+        # partitions have no queue of their own, let's check the parent device then
+        for folder in [device, os.path.dirname(device)]:
+            flag = os.path.join(folder, 'queue', 'rotational')
+            if os.path.isfile(flag):
+                with open(flag) as f:
+                    return f.read().strip() == '1'
+    except OSError as e:
+        log('Failed checking the disk of {} - {}'.format(path, e), common.WARNING)
+    return False
+
+
+class Quarantine(object):
+    """
+    Result of a job which exceeded decoding limits set in azoterc, or crashed the sandbox process
+    """
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def sandbox_jobs(function, jobs, workers=1, block=True, timeout=None):
+    """
+    Runs each job in a separate process, up to `workers` at a time, so that no picture may hang or crash Azote.
+    Processes are forked, to inherit common.settings and the log file handler; these exceeding 'decode_timeout'
+    (azoterc) get killed.
+    :param function: function to call with each job
+    :param jobs: list of job arguments, or JobQueue
+    :param workers: max. number of processes running at a time
+    :param block: if False, the generator yields (None, None) instead of waiting for processes; closing it kills
+    processes still running
+    :param timeout: seconds to kill processes after, 'decode_timeout' if None; 0 for no limit
+    :return: generator yielding (job, function return value or Quarantine object) tuples, in order of completion
+    """
+    context = multiprocessing.get_context('fork')
+    timeout = common.settings.decode_timeout if timeout is None else timeout
+    pending = jobs if isinstance(jobs, JobQueue) else JobQueue(jobs)
+    running = {}  # {receiving end of the pipe: (process, job, deadline)}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                job = pending.pop()
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=sandbox, args=(function, job, sender), daemon=True)
+                process.start()
+                sender.close()
+                deadline = time.monotonic() + timeout if timeout else None
+                running[receiver] = (process, job, deadline)
+
+            deadlines = [deadline for process, job, deadline in running.values() if deadline]
+            wait = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            ready = multiprocessing.connection.wait(list(running), wait if block else 0)
+            done = 0
+            for receiver in list(running):
+                process, job, deadline = running[receiver]
+                if receiver in ready:
+                    try:
+                        result = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        result = Quarantine('decoding process died, exit code {}'.format(process.exitcode))
+                elif deadline and time.monotonic() >= deadline:
+                    process.kill()
+                    result = Quarantine('decoding took more than {} s'.format(timeout))
+                else:
+                    continue
+                receiver.close()
+                process.join()
+                del running[receiver]
+                done += 1
+                yield job, result
+            if not done and not block:
+                yield None, None
+    finally:
+        for receiver, (process, job, deadline) in running.items():
+            process.kill()
+            process.join()
+            receiver.close()
+
+
+def sandbox(function, job, sender):
+    """
+    Runs in a sandbox process: applies decoding limits set in azoterc, and sends the function result back
+    (None if failed).
+    """
+    Image.MAX_IMAGE_PIXELS = common.settings.max_image_pixels if common.settings.max_image_pixels else None
+    # Pillow only warns if MAX_IMAGE_PIXELS exceeded less than twice
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+    if common.settings.decode_memory_mb:
+        # The forked process shares the address space of the GUI; let's only limit what it allocates on its own
+        with open('/proc/self/statm') as f:
+            used = int(f.read().split()[0]) * resource.getpagesize()
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = used + common.settings.decode_memory_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    try:
+        result = function(job)
+    except DECODING_LIMITS as e:
+        result = Quarantine('{}: {}'.format(type(e).__name__, e))
+    except Exception as e:
+        log('{} failed - {}'.format(function.__name__, e), common.ERROR)
+        result = None
+    sender.send(result)
+    sender.close()
+
+
+def run_sandboxed(function, job):
+    """
+    Runs a single job in a sandbox process, not to let a pathological picture hang or crash the GUI
+    :return: function return value, or Quarantine object
+    """
+    return next(sandbox_jobs(function, [job]))[1]
+
+
+def thumbnail_pack_path(scr_path):
+    packs_dir = os.path.join(common.thumb_dir, 'packs')
+    if not os.path.isdir(packs_dir):
+        os.mkdir(packs_dir)
+    return os.path.join(packs_dir, hash_name(scr_path))
+
+
+def open_thumbnail_pack(scr_path):
+    """
+    Opens the packed thumbnail store of the folder, to be read while filling the preview
+    """
+    if common.thumb_pack:
+        common.thumb_pack.close()
+    common.thumb_pack = ThumbnailPack(thumbnail_pack_path(scr_path), common.settings.thumb_size)
+
+
+def update_thumbnail_pack(scr_path, block=True):
+    """
+    Packs thumbnails created / changed since the last time, in a sandbox process not to decode them in the GUI
+    :param block: see sandbox_jobs
+    :return: generator yielding False while waiting for the sandbox process
+    """
+    thumbs = {record['thumb']: os.path.join(common.thumb_dir, record['thumb']) for record in
+              common.thumb_index.records.values() if record['thumb']}
+    # no 'decode_timeout': thumbnails are ours, and a big folder takes a while
+    for job, number in sandbox_jobs(pack_thumbnails_job, [(thumbnail_pack_path(scr_path), thumbs)], block=block,
+                                    timeout=0):
+        if not job:
+            yield False
+        elif number:
+            log('{} thumbnails packed for {}'.format(number, scr_path), common.INFO)
+    # the pack may have been rewritten
+    open_thumbnail_pack(scr_path)
+
+
+def pack_thumbnails_job(job):
+    """
+    Runs in a sandbox process
+    :param job: (pack path, {thumbnail name: thumbnail file path}) tuple
+    :return: number of thumbnails (re)packed
+    """
+    pack_path, thumbs = job
+    pack = ThumbnailPack(pack_path, common.settings.thumb_size)
+    try:
+        return pack.update(thumbs)
+    finally:
+        pack.close()
+
+
+def packed_pixbuf(thumb_name):
+    """
+    :param thumb_name: thumbnail file name
+    :return: GdkPixbuf.Pixbuf straight from the packed store, or None if not available
+    """
+    data = common.thumb_pack.frame(thumb_name) if common.thumb_pack else None
+    if not data:
+        return None
+    data, w, h = data
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data), GdkPixbuf.Colorspace.RGB, False, 8, w, h, w * 3)
+
+
+def thumbnail_bytes(thumb_name):
+    """
+    :param thumb_name: thumbnail file name
+    :return: disk usage of the thumbnail and its pyramid levels
+    """
+    total = 0
+    for path in [os.path.join(common.thumb_dir, thumb_name)] + [pyramid_path(thumb_name, width) for width in
+                                                                common.settings.thumbnail_pyramid]:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def delete_thumbnail(thumb_name):
+    for path in [os.path.join(common.thumb_dir, thumb_name)] + [pyramid_path(thumb_name, width) for width in
+                                                                common.settings.thumbnail_pyramid]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def evict_thumbnails(keep_folder):
+    """
+    Deletes least recently used thumbnails if the cache exceeds 'cache_max_mb' or 'cache_max_entries' azoterc values
+    :param keep_folder: current folder, which thumbnails must stay
+    """
+    evicted = common.thumb_index.evict(common.settings.cache_max_mb * 1024 * 1024, common.settings.cache_max_entries,
+                                       keep_folder)
+    for thumb_name in evicted:
+        delete_thumbnail(thumb_name)
+    if evicted:
+        log('Evicted {} least recently used thumbnails'.format(len(evicted)), common.INFO)
+
+
+def seed_thumbnail_totals():
+    """
+    Adds thumbnails created before the index existed to the cache totals; done once.
+    """
+    sizes = {}
+    with os.scandir(common.thumb_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                sizes[entry.name] = thumbnail_bytes(entry.name)
+    if sizes:
+        common.thumb_index.add_thumbnails(sizes, time.time())
+        log('{} existing thumbnails added to the cache index'.format(len(sizes)), common.INFO)
+
+
+def job_entries(result, stats, sharing):
+    """
+    :param result: thumbnail_job return value
+    :return: list of thumbnail index entries for the source file and other files of the same content; these w/o
+    thumbnail name if failed, not to retry decoding until the file changes
+    """
+    in_path, thumb_name, dimensions, features = result
+    paths = [in_path] + sharing[os.path.join(common.thumb_dir, thumb_name)]
+    if not dimensions:
+        return [(path, stats[path], None, None, None) for path in paths]
+    return [(path, stats[path], thumb_name, dimensions, features) for path in paths]
+
+
+def update_progress_bar(processed, total):
+    # no progress bar if headless
+    if common.progress_bar:
+        common.progress_bar.show()
+        common.progress_bar.set_fraction(processed / total)
+        common.progress_bar.set_text(str(processed))
+
+
+def hide_progress_bar():
+    if common.progress_bar:
+        common.progress_bar.hide()
+
+
+def thumbnail_job(job):
+    """
+    Runs in a sandbox process, up to 'thumbnail_workers' (azoterc) of them at a time
+    :param job: (in_path, dest_path, thumb_name, refresh, source changed) tuple
+    :return: (in_path, thumb_name, original image dimensions, features) tuple; dimensions None if failed
+    """
+    result = create_thumbnail(*job)
+    return (job[0], job[2]) + (result if result else (None, None))
+
+
+def convert_thumbnail_job(job):
+    """
+    Converts an existing thumbnail and its pyramid levels to the format set in azoterc
+    :param job: (in_path, old thumbnail name, new thumbnail name, image dimensions) tuple
+    :return: (in_path, new thumbnail name, True if succeeded, image dimensions) tuple
+    """
+    in_path, old_name, new_name, dimensions = job
+    try:
+        for folder in [common.thumb_dir] + [os.path.join(common.thumb_dir, str(width)) for width in
+                                            common.settings.thumbnail_pyramid]:
+            old_path, new_path = os.path.join(folder, old_name), os.path.join(folder, new_name)
+            # may have already been converted, if shared by files of the same content
+            if os.path.isfile(old_path):
+                with Image.open(old_path) as img:
+                    save_thumbnail(img, new_path)
+                os.remove(old_path)
+        log('Converted: {} -> {}'.format(old_name, new_name), common.INFO)
+        return in_path, new_name, os.path.isfile(os.path.join(common.thumb_dir, new_name)), dimensions
+    except Exception as e:
+        log('Failed converting {} - {}'.format(old_name, e), common.ERROR)
+        return in_path, new_name, False, dimensions
+
+
+def create_thumbnail(in_path, dest_path, thumb_name, refresh=False, changed=False):
+    """
+    The only time the picture gets decoded: whatever else we need to know about it is found here, see picture_features
+    :param refresh: True if the picture has been indexed, but its thumbnail is outdated
+    :param changed: True if the picture itself has changed since indexed: pyramid levels are outdated as well
+    :return: (original image (width, height), {feature: value}) tuple, or None if failed
+    """
+    action = 'New thumb' if not refresh else 'Refresh'
+    try:
+        img = Image.open(picture_source(in_path))
+        dimensions = img.size
+        if refresh:
+            # levels of the picture before it changed; these of another thumbnail width still do
+            for width in common.settings.thumbnail_pyramid:
+                path = pyramid_path(thumb_name, width)
+                if os.path.isfile(path) and (changed or is_newer(in_path, path)):
+                    os.remove(path)
+        # Derive from a bigger pyramid level, if we have one
+        preview = pyramid_thumbnail(thumb_name, common.settings.thumb_size)
+        if preview:
+            img = preview
+        else:
+            img = create_pyramid(img, in_path, dimensions, thumb_name)
+        # convert to thumbnail image
+        img.thumbnail(common.settings.thumb_size, Image.LANCZOS)
+        # Stored at the natural proportion; the preview letterboxes thumbnails while drawing
+        save_thumbnail(img, dest_path)
+        log('{}: {} -> {}'.format(action, in_path, thumb_name), common.INFO)
+        return dimensions, picture_features(img)
+    except DECODING_LIMITS:
+        # let the sandbox quarantine the picture
+        raise
+    except Exception as e:
+        log('{} - {}'.format(action, e), common.ERROR)
+
+
+def picture_features(img):
+    """
+    :param img: PIL.Image of the thumbnail
+    :return: {feature: value} dictionary to store in the thumbnail index: the placeholder; the colour histogram
+    palettes get generated of; the perceptual (difference) hash; mean luminance (0 - 255) and colourfulness
+    """
+    histogram = {}
+    number, luminance, rg_sum, rg_squares, yb_sum, yb_squares = 0, 0, 0, 0, 0, 0
+    for r, g, b, a in img.convert('RGBA').getdata():
+        number += 1
+        luminance += 0.299 * r + 0.587 * g + 0.114 * b
+        rg, yb = r - g, (r + g) / 2 - b
+        rg_sum += rg
+        rg_squares += rg * rg
+        yb_sum += yb
+        yb_squares += yb * yb
+        # the same pixels ColorThief takes into account: mostly opaque and not white
+        if a >= 125 and not (r > 250 and g > 250 and b > 250):
+            index = MMCQ.get_color_index(r >> MMCQ.RSHIFT, g >> MMCQ.RSHIFT, b >> MMCQ.RSHIFT)
+            histogram[index] = histogram.get(index, 0) + 1
+    # Hasler and Suesstrunk colourfulness metric
+    rg_mean, yb_mean = rg_sum / number, yb_sum / number
+    deviation = (max(rg_squares / number - rg_mean ** 2, 0) + max(yb_squares / number - yb_mean ** 2, 0)) ** 0.5
+    colourfulness = deviation + 0.3 * (rg_mean ** 2 + yb_mean ** 2) ** 0.5
+
+    return {'placeholder': placeholder(img),
+            'histogram': b''.join(struct.pack('<HI', index, count) for index, count in histogram.items()),
+            'phash': difference_hash(img),
+            'luminance': luminance / number,
+            'colourfulness': colourfulness}
+
+
+def difference_hash(img):
+    """
+    :param img: PIL.Image
+    :return: 64-bit dHash as a hex string; pictures looking alike differ in a few bits
+    """
+    pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return '{:016x}'.format(bits)
+
+
+def placeholder(img):
+    """
+    :param img: PIL.Image
+    :return: raw RGB bytes of the image shrunk to PLACEHOLDER_SIZE, for the preview to show until the thumbnail loads
+    """
+    return img.convert('RGB').resize(PLACEHOLDER_SIZE, Image.BOX).tobytes()
+
+
+def placeholder_pixbuf(data, dimensions):
+    """
+    :param data: placeholder bytes
+    :param dimensions: original image (width, height)
+    :return: GdkPixbuf.Pixbuf of the placeholder, scaled up to the thumbnail size
+    """
+    width, height = PLACEHOLDER_SIZE
+    pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data), GdkPixbuf.Colorspace.RGB, False, 8, width,
+                                             height, width * 3)
+    scale = min(common.settings.thumb_size[0] / dimensions[0], common.settings.thumb_size[1] / dimensions[1])
+    return pixbuf.scale_simple(max(int(dimensions[0] * scale), 1), max(int(dimensions[1] * scale), 1),
+                               GdkPixbuf.InterpType.BILINEAR)
+
+
+def create_pyramid(img, in_path, dimensions, thumb_name):
+    """
+    Creates (unpadded) pyramid levels, and the shared thumbnail if enabled, out of the best source available.
+    :param img: PIL.Image as returned by Image.open
+    :return: PIL.Image of the smallest size created, not yet fit into common.settings.thumb_size
+    """
+    # previews must be big enough to feed all the pyramid levels, not just the thumbnail
+    boxes = [pyramid_size(width) for width in common.settings.thumbnail_pyramid] + [common.settings.thumb_size]
+    box = (max(size[0] for size in boxes), max(size[1] for size in boxes))
+    # no shared thumbnails of archive members: the spec only knows files
+    level = shared_thumbnail_level(box) if common.settings.shared_thumbnails != 'off' and \
+        not archive_member(in_path) else None
+    preview = shared_thumbnail(in_path, dimensions, level) if level else None
+    if not preview and common.settings.exif_thumbnails:
+        preview = embedded_thumbnail(img, box)
+
+    # (box size, path to save to / True for the shared thumbnail), from the biggest to the smallest one
+    steps = [(pyramid_size(width), pyramid_path(thumb_name, width)) for width in common.settings.thumbnail_pyramid]
+    if level and not preview and common.settings.shared_thumbnails == 'write':
+        steps.append(((level[1], level[1]), True))
+    steps.sort(key=lambda step: max(step[0]), reverse=True)
+
+    if preview:
+        img = preview
+    else:
+        box = (max([box[0]] + [step[0][0] for step in steps]), max([box[1]] + [step[0][1] for step in steps]))
+        img = picture_backend(in_path).thumbnail(img, in_path, box,
+                                                 fast=common.settings.thumbnail_decoding == 'speed')
+
+    for size, path in steps:
+        # Don't save levels bigger than the image we've got
+        if img.size[0] < size[0] and img.size[1] < size[1]:
+            continue
+        img.thumbnail(size, Image.LANCZOS)
+        if path is True:
+            save_shared_thumbnail(img, in_path, level)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_thumbnail(img, path)
+    return img
+
+
+def pyramid_size(width):
+    return width, int(width * 135 / 240)
+
+
+def pyramid_path(thumb_name, width):
+    return os.path.join(common.thumb_dir, str(width), thumb_name)
+
+
+def pyramid_thumbnail(thumb_name, size, path_only=False):
+    """
+    :param thumb_name: thumbnail file name
+    :param size: (width, height) tuple we need the thumbnail of
+    :param path_only: return the level file path instead of the image
+    :return: PIL.Image of the smallest pyramid level not smaller than `size` (or its path), None if not found
+    """
+    for width in sorted(common.settings.thumbnail_pyramid):
+        if width >= size[0]:
+            path = pyramid_path(thumb_name, width)
+            if os.path.isfile(path):
+                if path_only:
+                    return path
+                img = Image.open(path)
+                img.load()
+                return img
+    return None
+
+
+def shrink_on_load(img, size):
+    """
+    If 'thumbnail_decoding' is set to 'speed' in azoterc, shrinks the just opened (not yet loaded) image
+    to the smallest size not lower than `size`, before the (slow) resampling takes place.
+    JPEG files are decoded by libjpeg at 1/2, 1/4 or 1/8 scale, other formats get reduced by an integer factor.
+    :param img: PIL.Image as returned by Image.open
+    :param size: (width, height) tuple we're going to create the thumbnail of
+    :return: PIL.Image
+    """
+    if common.settings.thumbnail_decoding == 'speed':
+        img = image_backend.shrink_on_load(img, size)
+    return img
+
+
+def embedded_thumbnail(img, size):
+    """
+    Camera JPEGs usually carry a small JPEG preview in the EXIF IFD1 directory. We only need to parse the APP1 segment
+    (already read by Image.open) to get it.
+    :param img: PIL.Image as returned by Image.open
+    :param size: (width, height) tuple we're going to create the thumbnail of
+    :return: PIL.Image of the preview, or None if not found, too small, or of a different aspect ratio
+    """
+    exif = img.info.get('exif') if img.format == 'JPEG' else None
+    if not exif or not exif.startswith(b'Exif\x00\x00'):
+        return None
+    tiff = exif[6:]
+    try:
+        bo = '<' if tiff[:2] == b'II' else '>'
+        # skip IFD0 entries to find the IFD1 offset
+        ifd0 = struct.unpack(bo + 'I', tiff[4:8])[0]
+        num_entries = struct.unpack(bo + 'H', tiff[ifd0:ifd0 + 2])[0]
+        pos = ifd0 + 2 + num_entries * 12
+        ifd1 = struct.unpack(bo + 'I', tiff[pos:pos + 4])[0]
+        if not ifd1:
+            return None
+        num_entries = struct.unpack(bo + 'H', tiff[ifd1:ifd1 + 2])[0]
+        offset, length = None, None
+        for i in range(num_entries):
+            entry = tiff[ifd1 + 2 + i * 12:ifd1 + 14 + i * 12]
+            tag, value = struct.unpack(bo + 'H', entry[:2])[0], struct.unpack(bo + 'I', entry[8:12])[0]
+            if tag == 0x0201:  # JPEGInterchangeFormat
+                offset = value
+            elif tag == 0x0202:  # JPEGInterchangeFormatLength
+                length = value
+        if offset is None or not length:
+            return None
+
+        preview = Image.open(io.BytesIO(tiff[offset:offset + length]))
+        width, height = preview.size
+        if width < size[0] or height < size[1]:
+            return None
+        # Previews of a different proportion are letterboxed - we don't want black stripes in our thumbnail
+        if abs(width / height - img.size[0] / img.size[1]) > 0.02:
+            return None
+        preview.load()
+        return preview
+
+    except Exception as e:
+        log('Failed reading EXIF thumbnail - {}'.format(e), common.WARNING)
+        return None
+
+
+def shared_thumbnail_uri(path):
+    # Same characters left unescaped as in g_filename_to_uri()
+    return 'file://{}'.format(urllib.parse.quote(os.path.abspath(path), safe="/!$&'()*+,;=:@"))
+
+
+def shared_thumbnail_level(size):
+    """
+    https://specifications.freedesktop.org/thumbnail-spec/latest/
+    :param size: (width, height) tuple we're going to create the thumbnail of
+    :return: (folder name, max dimension) of the smallest shared thumbnail not smaller than `size`, or None
+    """
+    for name, px in [('normal', 128), ('large', 256), ('x-large', 512), ('xx-large', 1024)]:
+        if px >= max(size):
+            return name, px
+    return None
+
+
+def shared_thumbnail(in_path, dimensions, level):
+    """
+    Looks for a valid thumbnail in the freedesktop shared cache (~/.cache/thumbnails), e.g. created by a file manager.
+    :param in_path: original file path
+    :param dimensions: original image (width, height)
+    :param level: (folder name, max dimension) as returned by shared_thumbnail_level
+    :return: PIL.Image of the shared thumbnail, or None if not found, outdated or too small
+    """
+    uri = shared_thumbnail_uri(in_path)
+    path = os.path.join(common.shared_thumb_dir, level[0], '{}.png'.format(hashlib.md5(uri.encode()).hexdigest()))
+    if not os.path.isfile(path):
+        return None
+    try:
+        img = Image.open(path)
+        if img.info.get('Thumb::URI') != uri or int(img.info.get('Thumb::MTime')) != int(os.path.getmtime(in_path)):
+            return None
+        # the shared thumbnail must not be smaller than what we'd get out of the original image
+        scale = min(level[1] / dimensions[0], level[1] / dimensions[1], 1)
+        if img.size[0] < int(dimensions[0] * scale) or img.size[1] < int(dimensions[1] * scale):
+            return None
+        img.load()
+        return img
+    except Exception as e:
+        log('Failed reading shared thumbnail {} - {}'.format(path, e), common.WARNING)
+        return None
+
+
+def save_shared_thumbnail(img, in_path, level):
+    """
+    Saves the image as a freedesktop spec-compliant thumbnail, for other applications to use
+    :param img: PIL.Image already scaled to fit in the `level` box
+    :param in_path: original file path
+    :param level: (folder name, max dimension) as returned by shared_thumbnail_level
+    """
+    uri = shared_thumbnail_uri(in_path)
+    folder = os.path.join(common.shared_thumb_dir, level[0])
+    path = os.path.join(folder, '{}.png'.format(hashlib.md5(uri.encode()).hexdigest()))
+    try:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Thumb::URI', uri)
+        info.add_text('Thumb::MTime', str(int(os.path.getmtime(in_path))))
+        info.add_text('Thumb::Size', str(os.path.getsize(in_path)))
+        info.add_text('Software', 'Azote')
+        # write to a temporary file and rename, as the spec demands
+        tmp_path = '{}.azote-{}'.format(path, os.getpid())
+        img.save(tmp_path, "PNG", pnginfo=info)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        log('Failed saving shared thumbnail {} - {}'.format(path, e), common.WARNING)
+
+
+def benchmark_thumbnails(folder, limit=50):
+    """
+    Creates thumbnails of up to `limit` pictures from the folder in memory, and prints average encoding time,
+    decoding time (with GdkPixbuf, as the GUI does) and size of a thumbnail, for each available thumbnail encoding.
+    """
+    encodings = [('png, compress level 6', "PNG", {'compress_level': 6}),
+                 ('png, compress level 1', "PNG", {'compress_level': 1}),
+                 ('jpeg, quality 85', "JPEG", {'quality': 85}),
+                 ('webp, quality 85', "WEBP", {'quality': 85})]
+    thumbs = []
+    for file in sorted(os.listdir(folder)):
+        if os.path.isfile(os.path.join(folder, file)) and file_allowed(os.path.join(folder, file)):
+            try:
+                img = shrink_on_load(Image.open(os.path.join(folder, file)), common.settings.thumb_size)
+                img.thumbnail(common.settings.thumb_size, Image.LANCZOS)
+                thumbs.append(img.convert('RGB'))
+            except Exception as e:
+                print('{}: {}'.format(file, e))
+        if len(thumbs) == limit:
+            break
+    if not thumbs:
+        print('No pictures found in {}'.format(folder))
+        return
+
+    print('\n{} thumbnails {} x {} px of pictures in {}\n'.format(len(thumbs), common.settings.thumb_size[0],
+                                                                    common.settings.thumb_size[1], folder))
+    print('{:<24}{:>14}{:>14}{:>14}'.format('encoding', 'encode [ms]', 'decode [ms]', 'size [kB]'))
+    for name, pil_format, params in encodings:
+        encoded = []
+        start = time.perf_counter()
+        try:
+            for img in thumbs:
+                buffer = io.BytesIO()
+                img.save(buffer, pil_format, **params)
+                encoded.append(buffer.getvalue())
+        except Exception as e:
+            print('{:<24}{:>14}'.format(name, 'n/a ({})'.format(e)))
+            continue
+        encode_time = (time.perf_counter() - start) * 1000 / len(thumbs)
+
+        start = time.perf_counter()
+        try:
+            for data in encoded:
+                loader = GdkPixbuf.PixbufLoader()
+                loader.write(data)
+                loader.close()
+            decode_time = '{:.2f}'.format((time.perf_counter() - start) * 1000 / len(thumbs))
+        except Exception:
+            decode_time = 'n/a'
+        size = sum(len(data) for data in encoded) / len(encoded) / 1024
+        print('{:<24}{:>14.2f}{:>14}{:>14.1f}'.format(name, encode_time, decode_time, size))
+    print()
+
+
+def flip_selected_wallpaper():
+    """
+    This creates vertically flipped image and its thumbnail and saves to ~/.azote/backgrounds
+    :return: thumbnail path, flipped image path; None if failed
+    """
+    if common.selected_wallpaper:
+        image_path = common.selected_wallpaper.source_path
+        reason = common.thumb_index.quarantined(image_path)
+        if not reason:
+            result = run_sandboxed(flip_job, (image_path, common.selected_wallpaper.filename))
+            if not isinstance(result, Quarantine):
+                return result
+            reason = result.reason
+            common.thumb_index.quarantine([image_path], reason)
+        log('Quarantined: {} - {}'.format(image_path, reason), common.ERROR)
+    return None
+
+
+def flip_job(job):
+    """
+    Runs in a sandbox process
+    :param job: (source path, file name) tuple
+    """
+    source_path, filename = job
+    try:
+        img_path = os.path.join(common.bcg_dir, "flipped-{}".format(filename))
+        flipped = picture_backend(source_path).flip(picture_source(source_path),
+                                                    os.path.join(common.tmp_dir, "flipped-{}".format(filename)),
+                                                    common.settings.thumb_size)
+
+        thumb_path = os.path.join(common.tmp_dir, "thumbnail-{}".format(filename))
+        save_thumbnail(flipped, thumb_path)
+        return thumb_path, img_path
+
+    except Exception as e:
+        log('Failed flipping {} - {}'.format(source_path, e), common.ERROR)
+
+
+def split_selected_wallpaper(num_parts):
+    """
+    :return: list of (part path, thumbnail path) tuples; None if failed
+    """
+    image_path = common.selected_wallpaper.source_path
+    reason = common.thumb_index.quarantined(image_path)
+    if not reason:
+        result = run_sandboxed(split_job, (image_path, common.selected_wallpaper.filename, num_parts))
+        if not isinstance(result, Quarantine):
+            return result
+        reason = result.reason
+        common.thumb_index.quarantine([image_path], reason)
+    log('Quarantined: {} - {}'.format(image_path, reason), common.ERROR)
+    return None
+
+
+def split_job(job):
+    """
+    Runs in a sandbox process
+    :param job: (source path, file name, number of parts) tuple
+    """
+    source_path, filename, num_parts = job
+    try:
+        backend = picture_backend(source_path)
+        width, height = backend.size(picture_source(source_path))
+        is_horizontal = width >= height
+        if is_horizontal:
+            part_width = width // num_parts
+            part_height = height
+        else:
+            part_width = width
+            part_height = height // num_parts
+        boxes = []
+        for i in range(num_parts):
+            if is_horizontal:
+                boxes.append((i * part_width, 0, i * part_width + part_width, part_height))
+            else:
+                boxes.append((0, i * part_height, part_width, i * part_height + part_height))
+        parts = backend.split(picture_source(source_path), boxes, [os.path.join(
+            common.tmp_dir, "part{}-{}".format(i, filename)) for i in range(num_parts)], common.settings.thumb_size)
+
+        paths_list = []
+        for i in range(num_parts):
+            img_path = os.path.join(common.bcg_dir, "part{}-{}".format(i, filename))
+            thumb_path = os.path.join(common.tmp_dir, "thumb-part{}-{}".format(i, filename))
+
+            save_thumbnail(parts[i], thumb_path)
+            paths = (img_path, thumb_path)
+            paths_list.append(paths)
+        return paths_list
+
+    except Exception as e:
+        log('Failed splitting {} - {}'.format(source_path, e), common.ERROR)
+
+
+def scale_and_crop(item, image_path, width, height):
+    reason = common.thumb_index.quarantined(image_path)
+    if not reason:
+        result = run_sandboxed(scale_and_crop_job, (image_path, width, height))
+        if isinstance(result, Quarantine):
+            reason = result.reason
+            common.thumb_index.quarantine([image_path], reason)
+    if reason:
+        log('Quarantined: {} - {}'.format(image_path, reason), common.ERROR)
+        return
+    common.preview.refresh()
+
+
+def scale_and_crop_job(job):
+    """
+    Runs in a sandbox process
+    :param job: (image_path, width, height) tuple
+    """
+    image_path, width, height = job
+    member = archive_member(image_path)
+    # pictures cropped out of archive members are saved next to the archive
+    out_path = os.path.join(os.path.dirname(member[0]), os.path.basename(image_path)) if member else image_path
+    picture_backend(image_path).scale_and_crop(picture_source(image_path), width, height, '{}-{}x{}{}'.format(
+        os.path.splitext(out_path)[0], width, height, os.path.splitext(out_path)[1]))
+
+
+def is_newer(in_path, dest_path):
+    return picture_stat(in_path).st_mtime > os.path.getmtime(dest_path)
+
+
+def file_allowed(path, stat_result=None):
+    return picture_format(path, stat_result) is not None
+
+
+def picture_format(path, stat_result=None):
+    """
+    Tells the format by the file header, whatever the extension. Results are kept until the file changes, in memory,
+    and in the thumbnail index for pictures of the folder loaded.
+    :param path: file path
+    :param stat_result: os.stat_result of the file, if already known
+    :return: format name (see image_backend.FORMATS), or None if not a picture, or no decoder of the format available
+    """
+    try:
+        st = stat_result if stat_result else picture_stat(path)
+    except OSError:
+        return None
+    probed = common.picture_formats.get(path)
+    if probed and probed[0] == st.st_mtime_ns and probed[1] == st.st_size:
+        return probed[2]
+    record = common.thumb_index.records.get(path)
+    if record and record.get('format') and record['size'] == st.st_size and record['mtime'] == st.st_mtime_ns:
+        # indexed, and not changed since
+        name = record['format']
+    else:
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(image_backend.HEADER_BYTES)
+        except OSError:
+            header = b''
+        name = image_backend.probe(header)
+    if not format_decodable(name):
+        name = None
+    common.picture_formats[path] = (st.st_mtime_ns, st.st_size, name)
+    return name
+
+
+def format_decodable(name):
+    """
+    :param name: format name, or None
+    :return: True if a decoder of the format is available
+    """
+    if name and name not in image_backend.decoders_loaded:
+        # optional plugins only get imported once such a file has been found
+        available = image_backend.decoder_available(name)
+        log('{} decoder {}'.format(name.upper(), 'loaded' if available else 'not available'),
+            common.INFO if available else common.WARNING)
+    return name is not None and image_backend.decoder_available(name)
+
+
+def update_status_bar():
+    common.status_bar.push(0, common.lang['thumbnails_in_cache'].format(common.thumb_index.count,
+                                                                        convert_bytes(common.thumb_index.bytes)))
+
+
+def clear_thumbnails(clear_all=False, levels=True):
+    """
+    :param clear_all: delete all thumbnails, not only these no longer in use
+    :param levels: delete pyramid levels as well (if clear_all)
+    """
+    if not clear_all:
+        deleted = 0
+        for deleted in garbage_collector():
+            pass
+        print('\nAzote: {} unused thumbnails deleted\n'.format(deleted))
+        return
+
+    number = 0
+    with os.scandir(common.thumb_dir) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    os.remove(entry.path)
+                    number += 1
+                elif entry.is_dir() and levels:
+                    shutil.rmtree(entry.path)
+            except Exception as e:
+                print(e)
+    if levels:
+        common.thumb_index.clear()
+    else:
+        # Thumbnail size changed: let's keep dimensions and placeholders to show until thumbnails get recreated
+        common.thumb_index.invalidate()
+    print('\nAzote: {} thumbnails deleted\n'.format(number))
+
+
+def garbage_collector(batch=500):
+    """
+    Deletes thumbnails no longer in use, i.e. these of deleted pictures, and of folders not browsed for more than
+    'gc_keep_days' (azoterc). Works in batches, to be run from GLib.idle_add without blocking the GUI.
+    :param batch: number of files to check between yields
+    :return: generator yielding the number of thumbnails deleted so far
+    """
+    keep_since = time.time() - common.settings.gc_keep_days * 86400
+    keep_folder = common.settings.src_path
+    # Folders not browsed for a long time, or gone
+    for folder in common.thumb_index.folders(keep_since):
+        if folder != keep_folder:
+            common.thumb_index.forget_folder(folder)
+    yield 0
+
+    # Pictures gone
+    for folder in common.thumb_index.folders():
+        paths = common.thumb_index.folder_paths(folder)
+        gone = []
+        for i in range(len(paths)):
+            if not os.path.isfile(paths[i]) and not archives.split_path(paths[i], os.path.isfile):
+                gone.append(paths[i])
+            if i % batch == 0:
+                yield 0
+        common.thumb_index.forget(gone)
+        common.thumb_index.forget_archives(folder)
+
+    # Thumbnails no picture refers to. Let's keep recent files the index has never seen, as they may have not been
+    # indexed yet.
+    referenced = common.thumb_index.referenced_thumbnails()
+    known = common.thumb_index.known_thumbnails()
+    deleted = []
+    with os.scandir(common.thumb_dir) as it:
+        for i, entry in enumerate(it):
+            if entry.is_file() and entry.name not in referenced and (entry.name in known or
+                                                                     entry.stat().st_mtime < keep_since):
+                delete_thumbnail(entry.name)
+                deleted.append(entry.name)
+            if i % batch == 0:
+                yield len(deleted)
+    common.thumb_index.forget_thumbnails(deleted)
+
+    # Orphaned pyramid levels
+    for width in common.settings.thumbnail_pyramid:
+        level_dir = os.path.join(common.thumb_dir, str(width))
+        if os.path.isdir(level_dir):
+            with os.scandir(level_dir) as it:
+                for i, entry in enumerate(it):
+                    if entry.name not in referenced and not os.path.isfile(
+                            os.path.join(common.thumb_dir, entry.name)) and entry.stat().st_mtime < keep_since:
+                        os.remove(entry.path)
+                    if i % batch == 0:
+                        yield len(deleted)
+    # Packed stores of forgotten folders
+    packs_dir = os.path.join(common.thumb_dir, 'packs')
+    if os.path.isdir(packs_dir):
+        packs = {hash_name(folder) for folder in common.thumb_index.folders()}
+        for file in os.listdir(packs_dir):
+            if os.path.splitext(file)[0] not in packs:
+                os.remove(os.path.join(packs_dir, file))
+    log('Garbage collector: {} unused thumbnails deleted'.format(len(deleted)), common.INFO)
+    yield len(deleted)
+
+
+def start_garbage_collector():
+    GLib.idle_add(garbage_collector_step, garbage_collector(), priority=GLib.PRIORITY_LOW)
+    return False
+
+
+def garbage_collector_step(collector):
+    try:
+        next(collector)
+        return True
+    except StopIteration:
+        if common.status_bar:
+            update_status_bar()
+        return False
+
+
+def convert_bytes(num):
+    """
+    https://stackoverflow.com/a/39988702/4040598
+    """
+    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if num < 1024.0:
+            return "%3.1f %s" % (num, x)
+        num /= 1024.0
 
 
 def create_pixbuf(size, color):
@@ -842,7 +2369,7 @@ class Settings(object):
         if self.old_thumb_width != self.thumb_width:
             self.old_thumb_width = self.thumb_width
             save_needed = True
-            log('New thumbnail width: {}, clearing existing thumbnails!'.format(self.thumb_width), common.WARNING)
+            log('New thumbnail width: {}, recreating existing thumbnails!'.format(self.thumb_width), common.WARNING)
             self.clear_thumbnails = True
 
         if save_needed:
@@ -930,6 +2457,156 @@ class Settings(object):
         log('Screen measurement delay: {} ms'.format(self.screen_measurement_delay),
             common.INFO)
 
+        try:
+            self.thumbnail_workers = int(rc['thumbnail_workers'])
+        except KeyError:
+            self.thumbnail_workers = 0
+            save_needed = True
+        log('Thumbnail workers: {} (0 = all cores, 1 = one sandbox process at a time)'.format(self.thumbnail_workers),
+            common.INFO)
+
+        try:
+            self.thumbnail_decoding = rc['thumbnail_decoding']
+            if self.thumbnail_decoding not in ['speed', 'quality']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.thumbnail_decoding = 'speed'
+            save_needed = True
+        log('Thumbnail decoding: {}'.format(self.thumbnail_decoding), common.INFO)
+
+        try:
+            self.exif_thumbnails = str_to_bool(rc['exif_thumbnails'])
+        except (KeyError, ValueError):
+            self.exif_thumbnails = False
+            save_needed = True
+        log('Use EXIF thumbnails: {}'.format(self.exif_thumbnails), common.INFO)
+
+        try:
+            self.thumbnail_keys = rc['thumbnail_keys']
+            if self.thumbnail_keys not in ['path', 'content', 'content-full']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.thumbnail_keys = 'path'
+            save_needed = True
+        log('Thumbnail keys: {}'.format(self.thumbnail_keys), common.INFO)
+
+        try:
+            self.shared_thumbnails = rc['shared_thumbnails']
+            if self.shared_thumbnails not in ['off', 'read', 'write']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.shared_thumbnails = 'read'
+            save_needed = True
+        log('Shared (freedesktop) thumbnails: {}'.format(self.shared_thumbnails), common.INFO)
+
+        try:
+            self.thumbnail_pyramid = [int(width) for width in rc['thumbnail_pyramid'].split(',') if width.strip()]
+        except (KeyError, ValueError):
+            self.thumbnail_pyramid = [480]
+            save_needed = True
+        log('Thumbnail pyramid levels: {}'.format(self.thumbnail_pyramid), common.INFO)
+
+        try:
+            self.cache_max_mb = int(rc['cache_max_mb'])
+        except KeyError:
+            self.cache_max_mb = 0
+            save_needed = True
+
+        try:
+            self.cache_max_entries = int(rc['cache_max_entries'])
+        except KeyError:
+            self.cache_max_entries = 0
+            save_needed = True
+        log('Thumbnail cache limits: {} MB, {} entries (0 = no limit)'.format(self.cache_max_mb,
+                                                                              self.cache_max_entries), common.INFO)
+
+        try:
+            self.gc_keep_days = int(rc['gc_keep_days'])
+        except KeyError:
+            self.gc_keep_days = 30
+            save_needed = True
+        log('Keep thumbnails of folders browsed within: {} days'.format(self.gc_keep_days), common.INFO)
+
+        try:
+            self.packed_thumbnails = str_to_bool(rc['packed_thumbnails'])
+        except (KeyError, ValueError):
+            self.packed_thumbnails = False
+            save_needed = True
+        log('Packed thumbnails: {}'.format(self.packed_thumbnails), common.INFO)
+
+        try:
+            self.thumbnail_format = rc['thumbnail_format']
+            if self.thumbnail_format not in ['png', 'jpeg', 'webp']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.thumbnail_format = 'png'
+            save_needed = True
+
+        try:
+            self.thumbnail_quality = int(rc['thumbnail_quality'])
+        except KeyError:
+            self.thumbnail_quality = 85
+            save_needed = True
+
+        try:
+            self.thumbnail_compress_level = int(rc['thumbnail_compress_level'])
+        except KeyError:
+            self.thumbnail_compress_level = 6
+            save_needed = True
+        log('Thumbnail format: {}, quality (jpeg, webp): {}, compress level (png): {}'.format(
+            self.thumbnail_format, self.thumbnail_quality, self.thumbnail_compress_level), common.INFO)
+
+        try:
+            self.decode_timeout = int(rc['decode_timeout'])
+        except KeyError:
+            self.decode_timeout = 30
+            save_needed = True
+
+        try:
+            self.decode_memory_mb = int(rc['decode_memory_mb'])
+        except KeyError:
+            self.decode_memory_mb = 1024
+            save_needed = True
+
+        try:
+            self.max_image_pixels = int(rc['max_image_pixels'])
+        except KeyError:
+            self.max_image_pixels = 178956970
+            save_needed = True
+        log('Decoding limits: {} s, {} MB, {} pixels (0 = no limit)'.format(
+            self.decode_timeout, self.decode_memory_mb, self.max_image_pixels), common.INFO)
+
+        try:
+            self.hdd_mode = rc['hdd_mode']
+            if self.hdd_mode not in ['auto', 'on', 'off']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.hdd_mode = 'auto'
+            save_needed = True
+        log('HDD mode (inode order & readahead): {}'.format(self.hdd_mode), common.INFO)
+
+        try:
+            self.recursive_scan = str_to_bool(rc['recursive_scan'])
+        except (KeyError, ValueError):
+            self.recursive_scan = False
+            save_needed = True
+        log('Recursive scan: {}'.format(self.recursive_scan), common.INFO)
+
+        try:
+            self.browse_archives = str_to_bool(rc['browse_archives'])
+        except (KeyError, ValueError):
+            self.browse_archives = True
+            save_needed = True
+        log('Browse archives: {}'.format(self.browse_archives), common.INFO)
+
+        try:
+            self.image_backend = rc['image_backend']
+            if self.image_backend not in ['auto', 'pillow', 'vips']:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.image_backend = 'auto'
+            save_needed = True
+
         if save_needed:
             self.save_rc()
 
@@ -943,6 +2620,26 @@ class Settings(object):
             self.palette_quality = 10
             self.tracking_interval_seconds = 5
             self.screen_measurement_delay = 300
+            self.thumbnail_workers = 0
+            self.thumbnail_decoding = 'speed'
+            self.exif_thumbnails = False
+            self.thumbnail_keys = 'path'
+            self.shared_thumbnails = 'read'
+            self.thumbnail_pyramid = [480]
+            self.cache_max_mb = 0
+            self.cache_max_entries = 0
+            self.gc_keep_days = 30
+            self.packed_thumbnails = False
+            self.thumbnail_format = 'png'
+            self.thumbnail_quality = 85
+            self.thumbnail_compress_level = 6
+            self.decode_timeout = 30
+            self.decode_memory_mb = 1024
+            self.max_image_pixels = 178956970
+            self.hdd_mode = 'auto'
+            self.image_backend = 'auto'
+            self.recursive_scan = False
+            self.browse_archives = True
 
         rc = {'thumb_width': str(self.thumb_width),
               'columns': str(self.columns),
@@ -951,7 +2648,27 @@ class Settings(object):
               'clip_prev_size': str(self.clip_prev_size),
               'palette_quality': str(self.palette_quality),
               'tracking_interval_seconds': str(self.tracking_interval_seconds),
-              'screen_measurement_delay': str(self.screen_measurement_delay)}
+              'screen_measurement_delay': str(self.screen_measurement_delay),
+              'thumbnail_workers': str(self.thumbnail_workers),
+              'thumbnail_decoding': self.thumbnail_decoding,
+              'exif_thumbnails': str(self.exif_thumbnails),
+              'thumbnail_keys': self.thumbnail_keys,
+              'shared_thumbnails': self.shared_thumbnails,
+              'thumbnail_pyramid': ','.join([str(width) for width in self.thumbnail_pyramid]),
+              'cache_max_mb': str(self.cache_max_mb),
+              'cache_max_entries': str(self.cache_max_entries),
+              'gc_keep_days': str(self.gc_keep_days),
+              'packed_thumbnails': str(self.packed_thumbnails),
+              'thumbnail_format': self.thumbnail_format,
+              'thumbnail_quality': str(self.thumbnail_quality),
+              'thumbnail_compress_level': str(self.thumbnail_compress_level),
+              'decode_timeout': str(self.decode_timeout),
+              'decode_memory_mb': str(self.decode_memory_mb),
+              'max_image_pixels': str(self.max_image_pixels),
+              'hdd_mode': self.hdd_mode,
+              'image_backend': self.image_backend,
+              'recursive_scan': str(self.recursive_scan),
+              'browse_archives': str(self.browse_archives)}
 
         with open(self.rc_file, 'w') as f:
             json.dump(rc, f, indent=2)